@@ -2977,6 +2977,7 @@ class Connection:
 #   - Person
 #   - TextStat
 #   - Subjects
+#   - The collate table
 #   No negative caching. No time-outs.
 #   Some automatic invalidation (if accept-async called appropriately).
 #
@@ -2997,6 +2998,8 @@ class CachedConnection(Connection):
         self.persons = Cache(self.fetch_person, "Person")
         self.textstats = Cache(self.fetch_textstat, "TextStat")
         self.subjects = Cache(self.fetch_subject, "Subject")
+        self.collate_table: bytes | None = None
+        self.collate_classes: dict[str, str] = {}
 
         # Setup up async handlers for invalidating cache entries.
         self.add_async_handler(ASYNC_NEW_NAME, self.cah_new_name)
@@ -3142,11 +3145,29 @@ class CachedConnection(Connection):
                                want_confs=want_confs).response()
         return [(x.conf_no, x.name.decode('latin1')) for x in matches]
 
+    def get_collate_table(self) -> bytes:
+        """Get the collate table, fetching it only the first time"""
+        if self.collate_table is None:
+            self.set_collate_table(ReqGetCollateTable(self).response())
+        assert self.collate_table is not None
+        return self.collate_table
+
+    def set_collate_table(self, collate_table: bytes) -> None:
+        """Use collate_table, e.g. kept from an earlier connection, and
+        group the chars into their classes of equivalent chars"""
+        classes: dict[int, str] = {}
+        for i, norm_char in enumerate(collate_table):
+            classes[norm_char] = classes.get(norm_char, "") + chr(i)
+        self.collate_table = collate_table
+        self.collate_classes = {c: classes[norm_char]
+                                for c, norm_char in zip(
+                                    map(chr, range(len(collate_table))),
+                                    collate_table)}
+
     def _case_insensitive_regexp(self, regexp: str) -> str:
         """Make regular expression case insensitive"""
         result = ""
-        # FIXME: Cache collate_table
-        collate_table = ReqGetCollateTable(self).response()
+        self.get_collate_table()
         inside_brackets = 0
         for c in regexp:
             if c == "[":
@@ -3155,7 +3176,7 @@ class CachedConnection(Connection):
             if inside_brackets:
                 eqv_chars = c
             else:
-                eqv_chars = self._equivalent_chars(c, collate_table)
+                eqv_chars = self._equivalent_chars(c)
 
             if len(eqv_chars) > 1:
                 result += f"[{eqv_chars}]"
@@ -3167,23 +3188,9 @@ class CachedConnection(Connection):
 
         return result
 
-    def _equivalent_chars(self, c: str, collate_table: bytes) -> str:
+    def _equivalent_chars(self, c: str) -> str:
         """Find all chars equivalent to c in collate table"""
-        c_ord = ord(c)
-        if c_ord >= len(collate_table):
-            return c
-
-        result: str = ""
-        norm_char = collate_table[c_ord]
-        next_index = 0
-        while 1:
-            next_index = collate_table.find(norm_char, next_index)
-            if next_index == -1:
-                break
-            result += chr(next_index)
-            next_index += 1
-
-        return result
+        return self.collate_classes.get(c, c)
 
     # Check if text_no is included in any read_range
     def text_in_read_ranges(self, text_no: int,
@@ -3199,7 +3206,7 @@ class CachedConnection(Connection):
         gaps: list[tuple[int, int]] = []
         last = 1
         for range in read_ranges:
-            gap = range.first_read - last - 1
+            gap = range.first_read - last
             if gap > 0:
                 gaps.append((last, gap))
             last = range.last_read + 1
@@ -3293,46 +3300,74 @@ class CachedUserConnection(CachedConnection):
         return len(self.get_unread_texts(no))
 
     def get_unread_texts(self, conf_no: int) -> list[int]:
-        unread: list[int] = []
         self.memberships.invalidate(conf_no)
         ms = self.memberships[conf_no]
-
-        # Start asking for translations
-#        ask_for = ms.last_text_read + 1
-#        more_to_fetch = 1
-#        while more_to_fetch:
-#            try:
-#                mapping = ReqLocalToGlobal(self, conf_no,
-#                                           ask_for, 255).response()
-#                for (local_num, global_num) in mapping.list:
-#                    if not self.text_in_read_ranges(local_num,
-#                                                    ms.read_ranges):
-#                        unread.append(global_num)
-#                        ask_for = mapping.range_end
-#                        more_to_fetch = mapping.later_texts_exists
-#            except NoSuchLocalText:
-#                # No unread texts
-#                more_to_fetch = 0
-        gaps, last = self.read_ranges_to_gaps_and_last(ms.read_ranges)
+        requests = self.request_unread_texts(conf_no, ms.read_ranges)
+        return self.collect_unread_texts(conf_no, *requests)
+
+    # Get the unread texts of several conferences, or of all conferences
+    # the user is an active member of. All requests for the memberships
+    # and for the gaps between the read ranges are sent before any
+    # response is read.
+    def get_unread_texts_in_confs(self, conf_nos: list[int] | None = None) \
+            -> dict[int, list[int]]:
+        ms_list: list[Membership11]
+        if conf_nos is None:
+            ms_list = [ms for ms in ReqGetMembership(
+                self, self._user_no, 0, 10000, want_read_ranges=1).response()
+                if not ms.type.passive]
+        else:
+            ms_reqs = [ReqQueryReadTexts(self, self._user_no, conf_no, 1, 0)
+                       for conf_no in conf_nos]
+            ms_list = [req.response() for req in ms_reqs]
+        pending = []
+        for ms in ms_list:
+            self.memberships[ms.conference] = ms
+            pending.append((ms.conference,
+                            self.request_unread_texts(ms.conference,
+                                                      ms.read_ranges)))
+        return {conf_no: self.collect_unread_texts(conf_no, *requests)
+                for conf_no, requests in pending}
+
+    # Send the mapping requests for the gaps between the read ranges and
+    # for the first texts after them, without waiting for the responses
+    def request_unread_texts(self, conf_no: int,
+                             read_ranges: list[ReadRange]) \
+            -> tuple[list[tuple[int, ReqLocalToGlobal]], int,
+                     ReqLocalToGlobal]:
+        gap_requests: list[tuple[int, ReqLocalToGlobal]] = []
+        gaps, last = self.read_ranges_to_gaps_and_last(read_ranges)
         for first, gap_len in gaps:
             while gap_len > 0:
-                if gap_len > 255:
-                    n = 255
-                else:
-                    n = gap_len
+                n = min(gap_len, 255)
+                gap_requests.append(
+                    (first + n, ReqLocalToGlobal(self, conf_no, first, n)))
+                first += n
                 gap_len -= n
-                mapping = ReqLocalToGlobal(self, conf_no, first, n).response()
-                unread.extend([e[1] for e in mapping.list])
-        more_to_fetch = 1
-        while more_to_fetch:
+        return gap_requests, last, ReqLocalToGlobal(self, conf_no, last, 255)
+
+    # Read the responses to request_unread_texts, and fetch the rest of
+    # the texts after the read ranges
+    def collect_unread_texts(self, conf_no: int,
+                             gap_requests: list[tuple[int, ReqLocalToGlobal]],
+                             last: int, request: ReqLocalToGlobal) \
+            -> list[int]:
+        unread: list[int] = []
+        for end, gap_request in gap_requests:
+            # The mapping may go on into the next read range
+            mapping = gap_request.response()
+            unread.extend([e[1] for e in mapping.list if e[0] < end])
+        while True:
             try:
-                mapping = ReqLocalToGlobal(self, conf_no, last, 255).response()
-                unread.extend([e[1] for e in mapping.list])
-                last = mapping.range_end
-                more_to_fetch = mapping.later_texts_exists
+                mapping = request.response()
             except NoSuchLocalText:
                 # No unread texts
-                more_to_fetch = 0
+                break
+            unread.extend([e[1] for e in mapping.list])
+            if not mapping.later_texts_exists:
+                break
+            last = mapping.range_end
+            request = ReqLocalToGlobal(self, conf_no, last, 255)
         return unread
 
     # Handlers for asynchronous messages (internal use)
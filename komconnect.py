@@ -6,6 +6,7 @@
 import argparse
 import getpass
 import os
+from typing import Callable
 
 import kom
 
@@ -32,10 +33,14 @@ def add_server_name_password(parser: argparse.ArgumentParser):
                       help="authenticate using PASS", metavar="PASS")
 
 # Connect and login using the information in an optparse options object
-# (e.g. one set up using add_server_name_password)
+# (e.g. one set up using add_server_name_password). The name is looked
+# up with lookup_person if given, e.g. to use a local name cache.
 
 
-def connect_and_login(options: argparse.Namespace):
+def connect_and_login(options: argparse.Namespace,
+                      lookup_person: Callable[[kom.CachedUserConnection, str],
+                                              list[tuple[int, str]]]
+                      | None = None):
 
     # Get server
     server = options.server
@@ -63,12 +68,15 @@ def connect_and_login(options: argparse.Namespace):
 
     # Connect
     try:
-        conn = kom.CachedConnection(server, trace=False)
+        conn = kom.CachedUserConnection(server)
     except kom.LocalError as err:
         raise Error(f"failed to connect ({err})")
 
     # Lookup name
-    persons = conn.lookup_name(name, want_pers=1, want_confs=0)
+    if lookup_person is not None:
+        persons = lookup_person(conn, name)
+    else:
+        persons = conn.lookup_name(name, want_pers=1, want_confs=0)
     if len(persons) == 0:
         raise Error("name not found")
     elif len(persons) != 1:
@@ -80,6 +88,7 @@ def connect_and_login(options: argparse.Namespace):
         kom.ReqLogin(conn, person_no, password).response()
     except kom.Error as err:
         raise Error(f"failed to log in ({err})")
+    conn.set_user(person_no, set_member_confs=False)
 
     # Done!
     return conn
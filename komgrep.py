@@ -0,0 +1,4275 @@
+"""PyKOMGrep
+Grep through lyskom texts to find the information you need.
+
+The pykomgrep command is a front end to this module.  To search from
+Python, log in with komconnect and iterate over search(), which yields
+a Match for each matching line:
+
+    for match in komgrep.search(conn, ['kernel'], [conf_no]):
+        print(match.text_no, match.line_no, match.line)
+"""
+
+import argparse
+import array
+import atexit
+import bisect
+import collections
+import collections.abc
+import contextlib
+import enum
+import fcntl
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import operator
+import os
+import queue
+import re
+import time
+import types
+import typing
+import select
+import signal
+import socket
+import sqlite3
+import struct
+import sys
+import threading
+import traceback
+import zlib
+
+import kom
+import komconnect
+
+try:
+    from re import _compiler as sre_compile
+    from re import _parser as sre_parse
+except ImportError:  # Before Python 3.11
+    import sre_compile
+    import sre_parse
+
+
+def parsetime(string: str):
+    """Parse a time string and return a UNIX timestamp"""
+
+    try:
+        return time.mktime(time.strptime(string, '%Y-%m-%d'))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(
+            f'{string:r} not in format %Y-%m-%d') from e
+
+
+def parsesize(string: str):
+    """Parse a size with an optional K, M or G suffix and return bytes"""
+
+    units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    if not (match := re.fullmatch(r'(\d+(?:\.\d*)?)([KMG]?)B?', string,
+                                  re.I)):
+        raise argparse.ArgumentTypeError(
+            f'{string!r} not a size like 500M or 2G')
+    return int(float(match[1]) * units[match[2].upper()])
+
+
+def parsecount(string: str):
+    """Parse a count of at least one"""
+
+    try:
+        count = int(string)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f'{string!r} not a number') from e
+    if count < 1:
+        raise argparse.ArgumentTypeError(f'{string!r} not at least 1')
+    return count
+
+
+def formatsize(size: int):
+    """Format a number of bytes for people to read"""
+
+    for unit in ('', 'K', 'M'):
+        if abs(size) < 1024:
+            return f'{size:.1f}{unit}' if unit else f'{size}'
+        size /= 1024
+    return f'{size:.1f}G'
+
+
+class Recipient(typing.NamedTuple):
+    """Cache information for a recipient of a text"""
+    conf_no: int
+    local_no: int
+    type: int = kom.MIR_TO
+
+
+class CommentLink(typing.NamedTuple):
+    """Cache information for a comment or footnote link"""
+    text_no: int
+    type: int = kom.MIC_COMMENT
+
+
+class TextStat(typing.NamedTuple):
+    """Cache information for TextStat"""
+    creation_time: float
+    encoding: str
+    author: int = 0
+    no_of_lines: int = 0
+    no_of_chars: int = 0
+    recipients: tuple[Recipient, ...] = ()
+    comment_to: tuple[CommentLink, ...] = ()
+
+
+class Match(typing.NamedTuple):
+    """A matching line of a text, as yielded by search."""
+    text_no: int
+    line_no: int             # Counting the subject as line 1
+    span: tuple[int, int]    # Of the first match in the line
+    line: str
+    found: typing.Any        # What re.findall would give for the line
+    creation_time: float
+    author: int
+
+
+class Tombstone(enum.IntEnum):
+    """Reasons for caching a text as unavailable."""
+    DELETED = 1        # Reported deleted by the server, final
+    NO_SUCH_TEXT = 2   # Deleted or not readable by us
+    ACCESS_DENIED = 3  # Not readable by us
+
+
+class ArgumentError(Exception):
+    """Raised when there is a problem with the command line arguments."""
+
+
+class EmptyListError(Exception):
+    """Raised when the text list is empty."""
+
+
+class SnapshotError(Exception):
+    """Raised when a cache snapshot cannot be read."""
+
+
+def default_cache_file() -> str:
+    """Get the default cache location in the XDG cache directory."""
+
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'pykomgrep', 'cache.sqlite')
+
+
+def default_socket_file() -> str:
+    """Get the default daemon socket in the XDG runtime directory."""
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or \
+        os.path.dirname(default_cache_file())
+    return os.path.join(runtime_dir, 'pykomgrep.socket')
+
+
+class CacheWriter(threading.Thread):
+    """Thread doing all writes to the cache file.
+
+    Statements are queued by the Cache and committed every commit_every
+    statements or commit_interval seconds, whichever comes first, so that
+    the write lock is only held briefly and other processes get their
+    turn.
+    """
+
+    def __init__(self, dbfile: str, timeout: float, commit_every: int,
+                 commit_interval: float):
+        super().__init__(name='cache writer', daemon=True)
+        self.dbfile = dbfile
+        self.timeout = timeout
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.queue: queue.Queue[tuple[str, typing.Any, bool]
+                                | threading.Event | None] = queue.Queue()
+        self.error: sqlite3.Error | None = None
+
+    def run(self) -> None:
+        conn = sqlite3.connect(self.dbfile, timeout=self.timeout)
+        pending = 0
+        deadline = 0.0
+        while True:
+            try:
+                item = self.queue.get(
+                    timeout=max(0.0, deadline - time.monotonic())
+                    if pending else None)
+            except queue.Empty:
+                item = threading.Event()
+            if isinstance(item, tuple):
+                sql, params, many = item
+                try:
+                    if many:
+                        conn.executemany(sql, params)
+                    else:
+                        conn.execute(sql, params)
+                except sqlite3.Error as err:
+                    self.error = err
+                if pending == 0:
+                    deadline = time.monotonic() + self.commit_interval
+                pending += 1
+                if pending < self.commit_every \
+                   and time.monotonic() < deadline:
+                    continue
+            try:
+                conn.commit()
+            except sqlite3.Error as err:
+                self.error = err
+            pending = 0
+            if item is None:
+                conn.close()
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+
+
+class ContentStore:
+    """Append-only store for text contents, read through mmap.
+
+    Texts are appended to a segment file as records of text number,
+    length and UTF-8 data.  A sorted index of text number, offset and
+    length covers the segment up to some offset, and records after that
+    are scanned into a dictionary when needed.  Several processes can
+    append to and read the same store, and lookups decode straight from
+    the mapped pages.  Compaction writes a new segment and index and
+    renames them into place; the index records the inode of the segment
+    it was built for, and readers and writers reopen the segment when
+    it has been replaced.
+    """
+
+    record = struct.Struct('<II')
+    entry = struct.Struct('<IQI')
+    header = struct.Struct('<8sQQ')
+    magic = b'PKGIDX2\0'
+    removed = 0xffffffff
+    reindex_after = 10000
+
+    def __init__(self, path: str):
+        self.segment_file = path + '.seg'
+        self.index_file = path + '.idx'
+        self.segment: typing.BinaryIO | None = None
+        self.segment_map: mmap.mmap | None = None
+        self.index_map: mmap.mmap | None = None
+        self.index_len = 0
+        self.inode = 0
+        self.scanned = 0
+        self.tail: dict[int, tuple[int, int]] = {}
+        self.open()
+
+    def open(self) -> None:
+        """Open the current segment and its index."""
+
+        if self.segment_map is not None:
+            self.segment_map.close()
+            self.segment_map = None
+        if self.segment is not None:
+            self.segment.close()
+        self.segment = open(self.segment_file, 'a+b')
+        self.inode = os.fstat(self.segment.fileno()).st_ino
+        self.scanned = 0
+        self.tail.clear()
+        self.load_index()
+        self.scan()
+
+    def load_index(self) -> None:
+        """Map the sorted index, if there is one for this segment."""
+
+        if self.index_map is not None:
+            self.index_map.close()
+            self.index_map = None
+        self.index_len = 0
+        try:
+            with open(self.index_file, 'rb') as index:
+                self.index_map = mmap.mmap(index.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return
+        magic, covered, inode = self.header.unpack_from(self.index_map)
+        if magic != self.magic or inode != self.inode:
+            self.index_map.close()
+            self.index_map = None
+            return
+        self.index_len = ((len(self.index_map) - self.header.size)
+                          // self.entry.size)
+        self.tail.clear()
+        self.scanned = covered
+
+    def scan(self) -> None:
+        """Read records appended after the last scan."""
+
+        try:
+            stat = os.stat(self.segment_file)
+        except FileNotFoundError:
+            return
+        if stat.st_ino != self.inode:
+            self.open()
+            return
+        size = stat.st_size
+        if size == 0:
+            return
+        if self.segment_map is None or len(self.segment_map) < size:
+            if self.segment_map is not None:
+                self.segment_map.close()
+            self.segment_map = mmap.mmap(self.segment.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+        pos = self.scanned
+        while pos + self.record.size <= size:
+            textno, length = self.record.unpack_from(self.segment_map, pos)
+            pos += self.record.size
+            if length == self.removed:
+                self.tail[textno] = (pos, length)
+                continue
+            if pos + length > size:
+                # Still being written by another process
+                pos -= self.record.size
+                break
+            self.tail[textno] = (pos, length)
+            pos += length
+        self.scanned = pos
+
+    def lock(self) -> None:
+        """Lock the current segment for writing."""
+
+        while True:
+            fcntl.flock(self.segment, fcntl.LOCK_EX)
+            if os.stat(self.segment_file).st_ino == self.inode:
+                return
+            # Replaced by a compaction while we waited
+            fcntl.flock(self.segment, fcntl.LOCK_UN)
+            self.open()
+
+    def unlock(self) -> None:
+        """Let other processes write to the segment."""
+
+        fcntl.flock(self.segment, fcntl.LOCK_UN)
+
+    def lookup(self, textno: int) -> tuple[int, int] | None:
+        """Find offset and length of a text in the segment."""
+
+        if textno in self.tail:
+            return self.tail[textno]
+        left = 0
+        right = self.index_len
+        while left < right:
+            i = left + (right - left) // 2
+            entry = self.entry.unpack_from(
+                self.index_map, self.header.size + i * self.entry.size)
+            if entry[0] == textno:
+                return entry[1], entry[2]
+            if entry[0] < textno:
+                left = i + 1
+            else:
+                right = i
+        return None
+
+    def content(self, textno: int) -> str | None:
+        """Try fetching text content from the store."""
+
+        self.scan()
+        location = self.lookup(textno)
+        if location is None or location[1] == self.removed:
+            return None
+        offset, length = location
+        with memoryview(self.segment_map) as view:
+            return str(view[offset:offset + length], 'utf-8')
+
+    def data(self, textno: int) -> bytes | None:
+        """Try fetching the UTF-8 encoded content of a text."""
+
+        self.scan()
+        location = self.lookup(textno)
+        if location is None or location[1] == self.removed:
+            return None
+        offset, length = location
+        return self.segment_map[offset:offset + length]
+
+    def has_content(self, textno: int) -> bool:
+        """Is there content for textno in the store?"""
+
+        self.scan()
+        location = self.lookup(textno)
+        return location is not None and location[1] != self.removed
+
+    def append(self, textno: int, data: bytes, length: int) -> None:
+        """Append a record to the segment."""
+
+        self.lock()
+        try:
+            self.segment.seek(0, os.SEEK_END)
+            pos = self.segment.tell() + self.record.size
+            self.segment.write(self.record.pack(textno, length) + data)
+            self.segment.flush()
+        finally:
+            self.unlock()
+        self.tail[textno] = (pos, length)
+
+    def append_many(self, records: typing.Iterable[tuple[int, bytes]]) \
+            -> None:
+        """Append UTF-8 encoded contents, holding the lock once."""
+
+        self.lock()
+        try:
+            self.segment.seek(0, os.SEEK_END)
+            for textno, data in records:
+                self.segment.write(self.record.pack(textno, len(data)))
+                self.tail[textno] = (self.segment.tell(), len(data))
+                self.segment.write(data)
+            self.segment.flush()
+        finally:
+            self.unlock()
+
+    def add_content(self, textno: int, content: str) -> None:
+        """Add text content to the store."""
+
+        data = content.encode('utf-8')
+        self.append(textno, data, len(data))
+
+    def remove_content(self, textno: int) -> None:
+        """Remove text content from the store."""
+
+        if self.has_content(textno):
+            self.append(textno, b'', self.removed)
+
+    def entries(self) -> dict[int, tuple[int, int]]:
+        """Get the current location of every text in the store."""
+
+        entries = {}
+        for i in range(self.index_len):
+            textno, offset, length = self.entry.unpack_from(
+                self.index_map, self.header.size + i * self.entry.size)
+            entries[textno] = (offset, length)
+        entries.update(self.tail)
+        return {textno: location for textno, location in entries.items()
+                if location[1] != self.removed}
+
+    def count(self) -> int:
+        """Count the texts in the store."""
+
+        self.scan()
+        return len(self.entries())
+
+    def size(self) -> int:
+        """Get the size of the segment and index files."""
+
+        return sum(os.path.getsize(file)
+                   for file in (self.segment_file, self.index_file)
+                   if os.path.exists(file))
+
+    def write_index(self, entries: list[tuple[int, tuple[int, int]]],
+                    covered: int, inode: int) -> None:
+        """Atomically replace the index with sorted entries."""
+
+        with open(self.index_file + '.new', 'wb') as index:
+            index.write(self.header.pack(self.magic, covered, inode))
+            for textno, (offset, length) in entries:
+                index.write(self.entry.pack(textno, offset, length))
+        os.replace(self.index_file + '.new', self.index_file)
+
+    def reindex(self) -> None:
+        """Write a sorted index covering the whole segment."""
+
+        self.lock()
+        try:
+            self.scan()
+            self.write_index(sorted(self.entries().items()), self.scanned,
+                             self.inode)
+        finally:
+            self.unlock()
+        self.load_index()
+
+    def compact(self, drop: typing.Container[int] = ()) -> int:
+        """Rewrite the segment without removed, replaced and dropped texts.
+
+        Returns the number of bytes reclaimed.
+        """
+
+        before = self.size()
+        self.lock()
+        try:
+            self.scan()
+            entries = []
+            with open(self.segment_file + '.new', 'wb') as segment:
+                for textno, (offset, length) in sorted(
+                        self.entries().items()):
+                    if textno in drop:
+                        continue
+                    segment.write(self.record.pack(textno, length))
+                    entries.append((textno, (segment.tell(), length)))
+                    segment.write(self.segment_map[offset:offset + length])
+                covered = segment.tell()
+                inode = os.fstat(segment.fileno()).st_ino
+            self.write_index(entries, covered, inode)
+            os.replace(self.segment_file + '.new', self.segment_file)
+        finally:
+            self.unlock()
+        self.open()
+        return before - self.size()
+
+    def close(self) -> None:
+        """Index the records appended since the last index, if many."""
+
+        if len(self.tail) >= self.reindex_after:
+            self.reindex()
+        if self.index_map is not None:
+            self.index_map.close()
+        if self.segment_map is not None:
+            self.segment_map.close()
+        self.segment.close()
+
+
+class Snapshot:
+    """A compact, columnar copy of a cache for moving it between hosts.
+
+    The file is a sequence of frames, each a name and zlib compressed
+    data.  A server frame with host and port starts the frames of that
+    server, one per column of each table.  Integer columns are stored as
+    64-bit differences from the previous value, so the sorted columns
+    compress to very little, and text columns as lines.  Text contents
+    come last, as the text numbers and lengths followed by the contents
+    in blocks of about block_size bytes.
+    """
+
+    magic = b'PKGSNAP1'
+    frame = struct.Struct('<HI')
+    block_size = 1 << 20
+    # Nearly as small as the default level, at a quarter of the time
+    level = 3
+
+    def __init__(self, path: str, mode: str):
+        self.file = open(path, mode + 'b')
+        if mode == 'w':
+            self.file.write(self.magic)
+        elif self.file.read(len(self.magic)) != self.magic:
+            raise SnapshotError(f'{path} is not a pykomgrep snapshot')
+
+    def close(self) -> None:
+        """Close the snapshot file."""
+
+        self.file.close()
+
+    def write(self, name: str, data: bytes) -> None:
+        """Write a frame."""
+
+        encoded = name.encode()
+        data = zlib.compress(data, self.level)
+        self.file.write(self.frame.pack(len(encoded), len(data)))
+        self.file.write(encoded + data)
+
+    def write_ints(self, name: str, values: list[int]) -> None:
+        """Write an integer column as differences."""
+
+        deltas = array.array('q', map(operator.sub, values,
+                                      itertools.chain([0], values)))
+        if sys.byteorder == 'big':
+            deltas.byteswap()
+        self.write(name, deltas.tobytes())
+
+    def write_strings(self, name: str, values: list[str]) -> None:
+        """Write a text column as lines."""
+
+        self.write(name, '\n'.join(values).encode())
+
+    def frames(self) -> typing.Iterator[tuple[str, bytes]]:
+        """Read the frames in order."""
+
+        while header := self.file.read(self.frame.size):
+            if len(header) < self.frame.size:
+                raise SnapshotError('snapshot is truncated')
+            name_length, length = self.frame.unpack(header)
+            name = self.file.read(name_length).decode()
+            data = self.file.read(length)
+            if len(data) < length:
+                raise SnapshotError('snapshot is truncated')
+            yield name, zlib.decompress(data)
+
+    @staticmethod
+    def ints(data: bytes) -> list[int]:
+        """Decode an integer column."""
+
+        deltas = array.array('q')
+        deltas.frombytes(data)
+        if sys.byteorder == 'big':
+            deltas.byteswap()
+        return list(itertools.accumulate(deltas))
+
+    @staticmethod
+    def strings(data: bytes) -> list[str]:
+        """Decode a text column."""
+
+        return data.decode().split('\n') if data else []
+
+
+class CacheFile:
+    """A cache file and the maintenance of everything in it.
+
+    One cache file can hold data from several servers.  Every row is
+    keyed by the server it came from, and rows that depend on the access
+    rights of the logged in person (mappings and unreadable texts) are
+    also keyed by that person.  Text contents are kept in text_cache or
+    in one ContentStore per server next to the file.
+    """
+
+    timeout = 30.0
+    schema_version = 7
+    tables = ['server_cache', 'textstat_cache', 'text_recipient_cache',
+              'text_comment_cache', 'text_cache', 'tombstone_cache',
+              'local_to_global_cache', 'created_texts_cache',
+              'text_used_cache', 'name_directory_cache', 'name_cache',
+              'saved_search_cache', 'saved_match_cache']
+    # Tables copied column by column in snapshots.  Contents are copied
+    # separately, and when texts were searched only matters locally.
+    snapshot_tables = ['textstat_cache', 'text_recipient_cache',
+                       'text_comment_cache', 'tombstone_cache',
+                       'local_to_global_cache', 'created_texts_cache']
+    # Tables of what the user saved, kept when a snapshot is imported
+    kept_tables = ['saved_search_cache', 'saved_match_cache']
+    # Columns identifying a row, kept unique by an index.  Files from
+    # before the indexes are deduped, keeping the last added row.
+    unique_keys = {
+        'textstat_cache': 'server, textno',
+        'text_recipient_cache': 'server, textno, confno',
+        'text_comment_cache': 'server, textno, comment_to',
+        'text_cache': 'server, textno',
+        'tombstone_cache': 'server, viewer, textno',
+        'local_to_global_cache': 'server, viewer, confno, local',
+        'created_texts_cache': 'server, viewer, persno, local'}
+    # Evict down to this part of the maximum size, so that not every
+    # run has to evict
+    shrink_to = 0.9
+
+    def __init__(self, dbfile: str | None = None):
+        self.dbfile = dbfile or default_cache_file()
+        self.store_dir = self.dbfile + '.d'
+        if directory := os.path.dirname(self.dbfile):
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(self.dbfile, timeout=self.timeout)
+        # Only takes effect on a new file, or on the next full vacuum
+        self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.upgrade()
+        self.create_tables()
+        self.create_indexes()
+        self.conn.commit()
+
+    def upgrade(self) -> None:
+        """Bring a cache written by an older version up to date.
+
+        Versions before 3 did not record which server the data came
+        from, so there is no way to keep it correctly and it is dropped.
+        Before version 7, rows could be added twice, so the duplicates
+        are removed before the unique indexes are created, replacing the
+        plain indexes on the same columns.  Later versions only need the
+        tables added since.
+        """
+
+        cursor = self.conn.cursor()
+        cursor.execute('PRAGMA user_version')
+        version = cursor.fetchone()[0]
+        if version < 3:
+            for table in self.tables:
+                cursor.execute(f'DROP TABLE IF EXISTS {table}')
+        elif version < 7:
+            self.create_tables()
+            self.dedup_rows()
+            for index in ('textstat_cache_textno', 'text_cache_textno',
+                          'local_to_global_cache_confno',
+                          'created_texts_cache_persno'):
+                cursor.execute(f'DROP INDEX IF EXISTS {index}')
+        if version < self.schema_version:
+            cursor.execute(f'PRAGMA user_version = {self.schema_version}')
+
+    def create_tables(self) -> None:
+        """Create the tables unless they already exist."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS server_cache (
+             server INTEGER PRIMARY KEY,
+             host   TEXT,
+             port   INTEGER,
+             UNIQUE (host, port)
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS textstat_cache (
+             server        INTEGER,
+             textno        INTEGER,
+             creation_time INTEGER,
+             encoding      TEXT,
+             author        INTEGER,
+             no_of_lines   INTEGER,
+             no_of_chars   INTEGER
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS text_recipient_cache (
+             server INTEGER,
+             textno INTEGER,
+             confno INTEGER,
+             local  INTEGER,
+             type   INTEGER
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS text_comment_cache (
+             server     INTEGER,
+             textno     INTEGER,
+             comment_to INTEGER,
+             type       INTEGER
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS text_cache (
+             server  INTEGER,
+             textno  INTEGER,
+             content TEXT
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS tombstone_cache (
+             server  INTEGER,
+             viewer  INTEGER,
+             textno  INTEGER,
+             reason  INTEGER,
+             checked INTEGER
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS local_to_global_cache (
+             server INTEGER,
+             viewer INTEGER,
+             confno INTEGER,
+             local  INTEGER,
+             global INTEGER
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS created_texts_cache (
+             server INTEGER,
+             viewer INTEGER,
+             persno INTEGER,
+             local  INTEGER,
+             global INTEGER
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS text_used_cache (
+             server INTEGER,
+             textno INTEGER,
+             used   INTEGER,
+             UNIQUE (server, textno)
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS settings_cache (
+             name  TEXT PRIMARY KEY,
+             value INTEGER
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS name_directory_cache (
+             server        INTEGER,
+             viewer        INTEGER,
+             fetched       INTEGER,
+             collate_table BLOB,
+             UNIQUE (server, viewer)
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS name_cache (
+             server    INTEGER,
+             viewer    INTEGER,
+             confno    INTEGER,
+             name      TEXT,
+             folded    TEXT,
+             letterbox INTEGER,
+             UNIQUE (server, viewer, confno)
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS saved_search_cache (
+             server  INTEGER,
+             viewer  INTEGER,
+             name    TEXT,
+             options TEXT,
+             checked INTEGER,
+             UNIQUE (server, viewer, name)
+           )''')
+        cursor.execute('''
+           CREATE TABLE IF NOT EXISTS saved_match_cache (
+             server  INTEGER,
+             viewer  INTEGER,
+             name    TEXT,
+             checked INTEGER,
+             textno  INTEGER,
+             line    TEXT
+           )''')
+
+    def create_indexes(self) -> None:
+        """Create the lookup indexes unless they already exist."""
+
+        cursor = self.conn.cursor()
+        for table, keys in self.unique_keys.items():
+            cursor.execute(f'''
+                CREATE UNIQUE INDEX IF NOT EXISTS {table}_key
+                    ON {table} ({keys})''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS textstat_cache_author
+                ON textstat_cache (server, author, textno)''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS text_recipient_cache_textno
+                ON text_recipient_cache (server, textno)''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS text_recipient_cache_confno
+                ON text_recipient_cache (server, confno, textno)''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS text_comment_cache_textno
+                ON text_comment_cache (server, textno)''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS text_comment_cache_comment_to
+                ON text_comment_cache (server, comment_to)''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS tombstone_cache_textno
+                ON tombstone_cache (server, textno)''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS name_cache_folded
+                ON name_cache (server, viewer, folded)''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS saved_match_cache_name
+                ON saved_match_cache (server, viewer, name, checked)''')
+
+    def server_id(self, host: str, port: int) -> int:
+        """Get the key for a server, adding it if it is new."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            INSERT OR IGNORE INTO server_cache (host, port)
+                 VALUES (?, ?)''', (host, port))
+        cursor.execute('''
+            SELECT server
+              FROM server_cache
+             WHERE host = ? AND port = ?''', (host, port))
+        server = cursor.fetchone()[0]
+        self.conn.commit()
+        return server
+
+    def servers(self) -> list[tuple[int, str, int]]:
+        """Get key, host and port of every server in the cache."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT server, host, port
+              FROM server_cache
+          ORDER BY server''')
+        return cursor.fetchall()
+
+    def store_path(self, server: int) -> str:
+        """Get the path of the content store for a server."""
+
+        return os.path.join(self.store_dir, str(server))
+
+    def stores(self) -> dict[int, str]:
+        """Get the paths of the existing content stores by server."""
+
+        return {server: self.store_path(server)
+                for server, _, _ in self.servers()
+                if os.path.exists(self.store_path(server) + '.seg')}
+
+    def name_directory(self, server: int,
+                       viewer: int) -> tuple[float, bytes] | None:
+        """Get when the names were fetched and the collate table."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT fetched, collate_table
+              FROM name_directory_cache
+             WHERE server = ? AND viewer = ?''', (server, viewer))
+        return cursor.fetchone()
+
+    def set_name_directory(self, server: int, viewer: int, collate: bytes,
+                           names: typing.Iterable[tuple[int, str, str,
+                                                        bool]]) -> None:
+        """Replace the names, given as number, name, folded name and
+        whether it is a person."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            DELETE FROM name_cache
+                  WHERE server = ? AND viewer = ?''', (server, viewer))
+        cursor.executemany('''
+            INSERT INTO name_cache
+                 VALUES (?, ?, ?, ?, ?, ?)''',
+                           ((server, viewer, conf_no, name, folded,
+                             letterbox)
+                            for conf_no, name, folded, letterbox in names))
+        cursor.execute('''
+            INSERT OR REPLACE INTO name_directory_cache
+                 VALUES (?, ?, ?, ?)''',
+                       (server, viewer, time.time(), collate))
+        self.conn.commit()
+
+    def names_from(self, server: int, viewer: int, prefix: str,
+                   want_pers: bool, want_confs: bool) \
+            -> list[tuple[int, str, str]]:
+        """Get number, name and folded name of the names whose folded
+        form starts with prefix."""
+
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT confno, name, folded
+              FROM name_cache
+             WHERE server = ? AND viewer = ?
+                   AND folded >= ? {'AND folded < ?' if prefix else ''}
+                   AND letterbox IN (?, ?)
+          ORDER BY folded''',
+                       (server, viewer, prefix,
+                        *([prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+                          if prefix else []),
+                        1 if want_pers else -1, 0 if want_confs else -1))
+        return cursor.fetchall()
+
+    def rename(self, server: int, conf_no: int, name: str) -> None:
+        """Change a name in the directory of every viewer."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT viewer, collate_table
+              FROM name_directory_cache
+             WHERE server = ?''', (server,))
+        for viewer, collate in cursor.fetchall():
+            cursor.execute('''
+                UPDATE name_cache
+                   SET name = ?, folded = ?
+                 WHERE server = ? AND viewer = ? AND confno = ?''',
+                           (name, NameDirectory.fold(name, collate),
+                            server, viewer, conf_no))
+        self.conn.commit()
+
+    def server_statistics(self, server: int) -> dict[str, int]:
+        """Count the cached rows of each kind for a server."""
+
+        cursor = self.conn.cursor()
+        counts = {}
+        for table in self.tables[1:]:
+            cursor.execute(f'''
+                SELECT count(*)
+                  FROM {table}
+                 WHERE server = ?''', (server,))
+            counts[table.removesuffix('_cache')] = cursor.fetchone()[0]
+        if path := self.stores().get(server):
+            store = ContentStore(path)
+            counts['text'] += store.count()
+            store.close()
+        return counts
+
+    def disk_usage(self) -> int:
+        """Get the size of the cache files on disk."""
+
+        files = [self.dbfile, self.dbfile + '-wal']
+        for path in self.stores().values():
+            files.extend((path + '.seg', path + '.idx'))
+        return sum(os.path.getsize(file) for file in files
+                   if os.path.exists(file))
+
+    def size(self) -> int:
+        """Get the size of the cache, not counting free pages."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('PRAGMA page_size')
+        page_size = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_count')
+        pages = cursor.fetchone()[0]
+        cursor.execute('PRAGMA freelist_count')
+        pages -= cursor.fetchone()[0]
+        return pages * page_size + sum(
+            os.path.getsize(path + suffix)
+            for path in self.stores().values()
+            for suffix in ('.seg', '.idx')
+            if os.path.exists(path + suffix))
+
+    def max_size(self) -> int | None:
+        """Get the configured maximum size, if any."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT value
+              FROM settings_cache
+             WHERE name = ?''', ('max_size',))
+        if res := cursor.fetchone():
+            return res[0]
+        return None
+
+    def set_max_size(self, max_size: int) -> None:
+        """Configure the maximum size, or remove the limit if 0."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            DELETE FROM settings_cache
+                  WHERE name = ?''', ('max_size',))
+        if max_size:
+            cursor.execute('''
+                INSERT INTO settings_cache
+                     VALUES (?, ?)''', ('max_size', max_size))
+        self.conn.commit()
+
+    def content_store(self) -> str:
+        """Get where new text contents are kept, as last chosen."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT value
+              FROM settings_cache
+             WHERE name = ?''', ('mmap_contents',))
+        if (res := cursor.fetchone()) and res[0]:
+            return 'mmap'
+        return 'sqlite'
+
+    def set_content_store(self, content_store: str) -> None:
+        """Choose where new text contents are kept from now on."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            INSERT OR REPLACE INTO settings_cache
+                            VALUES (?, ?)''',
+                       ('mmap_contents', int(content_store == 'mmap')))
+        self.conn.commit()
+
+    def dedup(self) -> int:
+        """Remove duplicate rows and compact the content stores.
+
+        Returns the number of rows removed.
+        """
+
+        removed = self.dedup_rows()
+        self.conn.commit()
+        for path in self.stores().values():
+            store = ContentStore(path)
+            store.compact()
+            store.close()
+        return removed
+
+    def dedup_rows(self) -> int:
+        """Remove the rows with the same key as a later one, without
+        committing.  Returns the number of rows removed."""
+
+        cursor = self.conn.cursor()
+        removed = 0
+        for table, keys in self.unique_keys.items():
+            cursor.execute(f'''
+                DELETE FROM {table}
+                      WHERE rowid NOT IN (SELECT max(rowid)
+                                            FROM {table}
+                                        GROUP BY {keys})''')
+            removed += cursor.rowcount
+        return removed
+
+    def evict(self, max_size: int) -> int:
+        """Drop the least recently searched contents until below max_size.
+
+        Textstats and mappings are kept, so evicted texts are still
+        found and only their contents are fetched again.  Returns the
+        number of texts evicted.
+        """
+
+        excess = self.size() - max_size
+        if excess <= 0:
+            return 0
+        cursor = self.conn.cursor()
+        cursor.execute('''
+               SELECT coalesce(u.used, 0), t.textno, t.server,
+                      length(CAST(t.content AS BLOB))
+                 FROM text_cache AS t
+            LEFT JOIN text_used_cache AS u
+                   ON u.server = t.server AND u.textno = t.textno''')
+        candidates = [(*row, False) for row in cursor.fetchall()]
+        stores = {}
+        for server, path in self.stores().items():
+            stores[server] = ContentStore(path)
+            cursor.execute('''
+                SELECT textno, used
+                  FROM text_used_cache
+                 WHERE server = ?''', (server,))
+            used = dict(cursor.fetchall())
+            candidates.extend(
+                (used.get(textno, 0), textno, server,
+                 ContentStore.record.size + length, True)
+                for textno, (_, length) in stores[server].entries().items())
+        candidates.sort(key=lambda candidate: candidate[:2])
+
+        evicted = []
+        dropped: dict[int, set[int]] = collections.defaultdict(set)
+        freed = 0
+        for _, textno, server, size, in_store in candidates:
+            if freed >= excess:
+                break
+            evicted.append((server, textno))
+            if in_store:
+                dropped[server].add(textno)
+            freed += size
+        cursor.executemany('''
+            DELETE FROM text_cache
+                  WHERE server = ? AND textno = ?''', evicted)
+        cursor.executemany('''
+            DELETE FROM text_used_cache
+                  WHERE server = ? AND textno = ?''', evicted)
+        self.conn.commit()
+        for server, store in stores.items():
+            if dropped[server]:
+                store.compact(dropped[server])
+            store.close()
+        return len(evicted)
+
+    def vacuum(self, full: bool = False) -> None:
+        """Give free pages back to the file system.
+
+        An incremental vacuum runs alongside other processes using the
+        cache, but only works on files created with auto_vacuum.  A full
+        vacuum rewrites the whole file and turns auto_vacuum on.
+        """
+
+        self.conn.commit()
+        cursor = self.conn.cursor()
+        if full:
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            cursor.execute('VACUUM')
+        else:
+            cursor.execute('PRAGMA incremental_vacuum').fetchall()
+        cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+    def columns(self, table: str) -> list[tuple[str, str]]:
+        """Get name and type of the columns of a table, except server."""
+
+        cursor = self.conn.cursor()
+        cursor.execute(f'PRAGMA table_info({table})')
+        return [(row[1], row[2]) for row in cursor.fetchall()
+                if row[1] != 'server']
+
+    def export_snapshot(self, path: str) -> None:
+        """Write everything in the cache, without duplicates, to path."""
+
+        snapshot = Snapshot(path, 'w')
+        cursor = self.conn.cursor()
+        for server, host, port in self.servers():
+            snapshot.write_strings('server', [host, str(port)])
+            for table in self.snapshot_tables:
+                columns = self.columns(table)
+                keys = self.unique_keys[table]
+                cursor.execute(f'''
+                    SELECT {', '.join(name for name, _ in columns)}
+                      FROM {table}
+                     WHERE rowid IN (SELECT max(rowid)
+                                       FROM {table}
+                                      WHERE server = ?
+                                   GROUP BY {keys})
+                  ORDER BY {keys}''', (server,))
+                rows = cursor.fetchall()
+                for i, (name, kind) in enumerate(columns):
+                    if kind == 'TEXT':
+                        snapshot.write_strings(f'{table}.{name}',
+                                               [row[i] for row in rows])
+                    else:
+                        snapshot.write_ints(f'{table}.{name}',
+                                            [int(row[i]) for row in rows])
+            self.export_contents(snapshot, server)
+        snapshot.close()
+
+    def export_contents(self, snapshot: Snapshot, server: int) -> None:
+        """Write the text contents of a server to a snapshot."""
+
+        store = None
+        stored: dict[int, tuple[int, int]] = {}
+        if path := self.stores().get(server):
+            store = ContentStore(path)
+            stored = store.entries()
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT textno, length(CAST(content AS BLOB))
+              FROM text_cache
+             WHERE server = ?''', (server,))
+        lengths = {textno: length for textno, length in cursor.fetchall()}
+        lengths.update((textno, length)
+                       for textno, (_, length) in stored.items())
+        textnos = sorted(lengths)
+        snapshot.write_ints('text.textno', textnos)
+        snapshot.write_ints('text.length',
+                            [lengths[textno] for textno in textnos])
+
+        cursor.execute('''
+              SELECT textno, content
+                FROM text_cache
+               WHERE rowid IN (SELECT max(rowid)
+                                 FROM text_cache
+                                WHERE server = ?
+                             GROUP BY server, textno)
+            ORDER BY textno''', (server,))
+        rows = iter(cursor)
+        row = next(rows, None)
+        block = bytearray()
+        for textno in textnos:
+            while row is not None and row[0] < textno:
+                row = next(rows, None)
+            if textno in stored:
+                block += store.data(textno)
+            else:
+                block += row[1].encode('utf-8')
+            if len(block) >= snapshot.block_size:
+                snapshot.write('text.block', block)
+                block.clear()
+        if block:
+            snapshot.write('text.block', block)
+        if store is not None:
+            store.close()
+
+    def import_snapshot(self, path: str, content_store: str) -> None:
+        """Replace the cached data of the servers in a snapshot.
+
+        The indexes are dropped while loading and built afterwards,
+        when all rows are in place.  Contents are loaded into text_cache
+        or, with the mmap content store, into the store of each server,
+        and any contents stored before are dropped from both.
+        """
+
+        snapshot = Snapshot(path, 'r')
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT name
+              FROM sqlite_master
+             WHERE type = 'index' AND sql IS NOT NULL''')
+        for (index,) in cursor.fetchall():
+            cursor.execute(f'DROP INDEX {index}')
+        self.conn.commit()
+
+        server = 0
+        columns: dict[str, list[typing.Any]] = {}
+        store = None
+        textnos: collections.deque[tuple[int, int]] = collections.deque()
+        pending = bytearray()
+        for name, data in snapshot.frames():
+            if name == 'server':
+                host, port = Snapshot.strings(data)
+                server = self.server_id(host, int(port))
+                for table in self.tables[1:]:
+                    if table in self.kept_tables:
+                        continue
+                    cursor.execute(f'''
+                        DELETE FROM {table}
+                              WHERE server = ?''', (server,))
+                if store is not None:
+                    store.close()
+                    store = None
+                if content_store == 'mmap' or os.path.exists(
+                        self.store_path(server) + '.seg'):
+                    os.makedirs(self.store_dir, exist_ok=True)
+                    store = ContentStore(self.store_path(server))
+                    store.compact(store.entries())
+                    if content_store != 'mmap':
+                        store.close()
+                        store = None
+            elif name == 'text.length':
+                textnos.extend(zip(columns.pop('text.textno'),
+                                   Snapshot.ints(data)))
+            elif name == 'text.block':
+                pending += data
+                contents = []
+                offset = 0
+                while textnos and offset + textnos[0][1] <= len(pending):
+                    textno, length = textnos.popleft()
+                    contents.append((textno,
+                                     bytes(pending[offset:offset + length])))
+                    offset += length
+                del pending[:offset]
+                if store is not None:
+                    store.append_many(contents)
+                else:
+                    cursor.executemany('''
+                        INSERT INTO text_cache
+                             VALUES (?, ?, ?)''',
+                                       ((server, textno, content.decode())
+                                        for textno, content in contents))
+            else:
+                table, _, column = name.partition('.')
+                if table == 'text':
+                    columns[name] = Snapshot.ints(data)
+                    continue
+                if table not in self.snapshot_tables:
+                    raise SnapshotError(f'unknown column {name}')
+                kinds = dict(self.columns(table))
+                columns[name] = (Snapshot.strings(data)
+                                 if kinds[column] == 'TEXT'
+                                 else Snapshot.ints(data))
+                if all(f'{table}.{column}' in columns for column in kinds):
+                    values = [columns.pop(f'{table}.{column}')
+                              for column in kinds]
+                    cursor.executemany(f'''
+                        INSERT INTO {table}
+                             VALUES (?{', ?' * len(kinds)})''',
+                                       ((server, *row)
+                                        for row in zip(*values)))
+            self.conn.commit()
+        if textnos:
+            raise SnapshotError('snapshot is truncated')
+        if store is not None:
+            store.reindex()
+            store.close()
+        snapshot.close()
+        # Snapshots of older caches may hold duplicates
+        self.dedup_rows()
+        self.create_indexes()
+        self.conn.commit()
+
+    def enforce_max_size(self, dedup: bool = False) -> int:
+        """Shrink the cache if it has grown past the maximum size.
+
+        Only contents are evicted, compacting each store once, unless
+        dedup is set to remove duplicate rows and compact all stores
+        first.  That holds the write lock for long, so it is left to the
+        cache command.  Returns the number of texts evicted.
+        """
+
+        if not (max_size := self.max_size()) or self.size() <= max_size:
+            return 0
+        if dedup:
+            self.dedup()
+        evicted = self.evict(int(max_size * self.shrink_to))
+        self.vacuum()
+        return evicted
+
+
+class Cache(CacheFile):
+    """Class keeping a cache to lessen the need for network requests.
+
+    Reads go straight to the file, while writes are queued for a
+    CacheWriter thread.
+    """
+
+    commit_every = 1000
+    commit_interval = 5.0
+
+    def __init__(self, host: str, port: int, viewer: int,
+                 dbfile: str | None = None,
+                 content_store: str | None = None):
+        super().__init__(dbfile)
+        self.host = host
+        self.port = port
+        self.server = self.server_id(host, port)
+        self.viewer = viewer
+        if content_store is None:
+            content_store = self.content_store()
+        elif content_store != self.content_store():
+            self.set_content_store(content_store)
+        # Contents are looked up in both, but only added where chosen
+        self.in_store = content_store == 'mmap'
+        self.store: ContentStore | None = None
+        if self.in_store or os.path.exists(self.store_path(self.server)
+                                           + '.seg'):
+            os.makedirs(self.store_dir, exist_ok=True)
+            self.store = ContentStore(self.store_path(self.server))
+        self.recent_textstats: dict[int, TextStat] = {}
+        self.writer = CacheWriter(self.dbfile, self.timeout,
+                                  self.commit_every, self.commit_interval)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def statistics(self) -> dict[str, int]:
+        """Count the cached rows of each kind for this server."""
+
+        return self.server_statistics(self.server)
+
+    def write(self, sql: str, params: typing.Sequence[typing.Any]) -> None:
+        """Queue a statement for the writer thread."""
+
+        self.writer.queue.put((sql, params, False))
+
+    def write_many(self, sql: str,
+                   params: typing.Iterable[typing.Sequence[typing.Any]]) \
+            -> None:
+        """Queue a statement to be executed for each set of parameters."""
+
+        self.writer.queue.put((sql, list(params), True))
+
+    def commit(self) -> None:
+        """Wait until all queued changes are committed to the database."""
+
+        done = threading.Event()
+        self.writer.queue.put(done)
+        done.wait()
+        self.recent_textstats.clear()
+        if self.writer.error is not None:
+            error, self.writer.error = self.writer.error, None
+            raise error
+
+    def close(self) -> None:
+        """Commit queued changes, stop the writer thread and shrink the
+        cache if it has grown too large.  The cache can not be used
+        after this."""
+
+        atexit.unregister(self.close)
+        if self.writer.is_alive():
+            self.writer.queue.put(None)
+            self.writer.join()
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+        self.enforce_max_size()
+        self.conn.close()
+
+    def textstat(self, textno: int) -> TextStat | None:
+        """Try fetching a textstat from cache."""
+
+        if textno in self.recent_textstats:
+            return self.recent_textstats[textno]
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT creation_time, encoding, author, no_of_lines, no_of_chars
+              FROM textstat_cache
+             WHERE server = ? AND textno = ?''', (self.server, textno))
+        if not (res := cursor.fetchone()):
+            return None
+        cursor.execute('''
+            SELECT confno, local, type
+              FROM text_recipient_cache
+             WHERE server = ? AND textno = ?''', (self.server, textno))
+        recipients = tuple(Recipient(*row) for row in cursor.fetchall())
+        cursor.execute('''
+            SELECT comment_to, type
+              FROM text_comment_cache
+             WHERE server = ? AND textno = ?''', (self.server, textno))
+        comment_to = tuple(CommentLink(*row) for row in cursor.fetchall())
+        return TextStat(*res, recipients, comment_to)
+
+    def add_textstat(self, textno: int, textstat: TextStat) -> None:
+        """Add a textstat to the cache, replacing any earlier one."""
+
+        # Keep it readable until the writer thread has committed it.
+        if len(self.recent_textstats) >= self.commit_every:
+            self.commit()
+        self.recent_textstats[textno] = textstat
+        for table in ('textstat_cache', 'text_recipient_cache',
+                      'text_comment_cache'):
+            self.write(f'''
+                DELETE FROM {table}
+                      WHERE server = ? AND textno = ?''',
+                       (self.server, textno))
+        self.write('''
+            INSERT OR REPLACE INTO textstat_cache
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                   (self.server, textno, textstat.creation_time,
+                    textstat.encoding, textstat.author,
+                    textstat.no_of_lines, textstat.no_of_chars))
+        self.write_many('''
+            INSERT OR REPLACE INTO text_recipient_cache
+                            VALUES (?, ?, ?, ?, ?)''',
+                        ((self.server, textno, *rcpt)
+                         for rcpt in textstat.recipients))
+        self.write_many('''
+            INSERT OR REPLACE INTO text_comment_cache
+                            VALUES (?, ?, ?, ?)''',
+                        ((self.server, textno, *link)
+                         for link in textstat.comment_to))
+
+    def content(self, textno: int) -> str | None:
+        """Try fetching text content from cache."""
+
+        if self.store is not None \
+           and (content := self.store.content(textno)) is not None:
+            return content
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT content
+              FROM text_cache
+             WHERE server = ? AND textno = ?''', (self.server, textno))
+        if res := cursor.fetchone():
+            return res[0]
+        return None
+
+    def has_content(self, textno: int) -> bool:
+        """Is there a content row for textno in cache?"""
+
+        if self.store is not None and self.store.has_content(textno):
+            return True
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT 1
+              FROM text_cache
+             WHERE server = ? AND textno = ?''', (self.server, textno))
+        return cursor.fetchone() is not None
+
+    def add_content(self, textno: int, content: str) -> None:
+        """Add text content to the cache, replacing any earlier one."""
+
+        self.write('''
+            DELETE FROM tombstone_cache
+                  WHERE server = ? AND textno = ?''', (self.server, textno))
+        self.write('''
+            DELETE FROM text_cache
+                  WHERE server = ? AND textno = ?''', (self.server, textno))
+        if self.in_store:
+            self.store.add_content(textno, content)
+            return
+        if self.store is not None:
+            self.store.remove_content(textno)
+        self.write('''
+            INSERT OR REPLACE INTO text_cache
+                            VALUES (?, ?, ?)''',
+                   (self.server, textno, content))
+
+    def touch(self, textnos: typing.Iterable[int]) -> None:
+        """Record that texts were searched, for eviction."""
+
+        now = int(time.time())
+        self.write_many('''
+            INSERT OR REPLACE INTO text_used_cache
+                            VALUES (?, ?, ?)''',
+                        ((self.server, textno, now) for textno in textnos))
+
+    def tombstone(self, textno: int) -> tuple[Tombstone, int] | None:
+        """Try fetching the reason and check time for an unavailable text.
+
+        Deleted texts are unavailable to everyone, other tombstones only
+        to the person who could not read the text.
+        """
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT reason, checked
+              FROM tombstone_cache
+             WHERE server = ? AND textno = ? AND viewer IN (0, ?)''',
+                       (self.server, textno, self.viewer))
+        if res := cursor.fetchone():
+            return Tombstone(res[0]), res[1]
+        return None
+
+    def add_tombstone(self, textno: int, reason: Tombstone) -> None:
+        """Cache a text as unavailable, dropping any cached content."""
+
+        viewer = 0 if reason == Tombstone.DELETED else self.viewer
+        if self.store is not None:
+            self.store.remove_content(textno)
+        self.write('''
+            DELETE FROM text_cache
+                  WHERE server = ? AND textno = ?''', (self.server, textno))
+        self.write('''
+            DELETE FROM tombstone_cache
+                  WHERE server = ? AND textno = ? AND viewer IN (0, ?)''',
+                   (self.server, textno, self.viewer))
+        self.write('''
+            INSERT OR REPLACE INTO tombstone_cache
+                            VALUES (?, ?, ?, ?, ?)''',
+                   (self.server, viewer, textno, reason, int(time.time())))
+
+    def last_local(self, confno: int) -> int | None:
+        """Try fetching the last local textno from cache."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT max(local)
+              FROM local_to_global_cache
+             WHERE server = ? AND viewer = ? AND confno = ?''',
+                       (self.server, self.viewer, confno))
+        if res := cursor.fetchone():
+            return res[0]
+        return None
+
+    def global_text_list(self, confno: int, newest_first: bool = False,
+                         after: int = 0,
+                         last: int | None = None) -> list[int]:
+        """Try fetching the global textnos after a textno from cache,
+        up to the local number last if given."""
+
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT global
+              FROM local_to_global_cache
+             WHERE server = ? AND viewer = ? AND confno = ? AND global > ?
+                   AND local <= ?
+          ORDER BY {'local DESC' if newest_first else 'global'}''',
+                       (self.server, self.viewer, confno, after,
+                        sys.maxsize if last is None else last))
+        res = cursor.fetchall()
+        if res:
+            return [row[0] for row in res]
+        return []
+
+    def add_local_to_global(self, confno: int,
+                            ltg: list[tuple[int, int]]) -> None:
+        """Add a list of local/global tuples to cache."""
+
+        self.write_many('''
+            INSERT OR REPLACE INTO local_to_global_cache
+                            VALUES (?, ?, ?, ?, ?)''',
+                        ((self.server, self.viewer, confno, e[0], e[1])
+                         for e in ltg))
+
+    def remove_local_to_global(self, confno: int, textno: int) -> None:
+        """Remove a text from the cached mappings of a conference."""
+
+        self.write('''
+            DELETE FROM local_to_global_cache
+                  WHERE server = ? AND confno = ? AND global = ?''',
+                   (self.server, confno, textno))
+
+    def last_created(self, persno: int) -> int | None:
+        """Try fetching the last created textno from cache."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT max(local)
+              FROM created_texts_cache
+             WHERE server = ? AND viewer = ? AND persno = ?''',
+                       (self.server, self.viewer, persno))
+        if res := cursor.fetchone():
+            return res[0]
+        return None
+
+    def created_text_list(self, persno: int, newest_first: bool = False,
+                          after: int = 0,
+                          last: int | None = None) -> list[int]:
+        """Try fetching the created textnos after a textno from cache,
+        up to the local number last if given."""
+
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+            SELECT global
+              FROM created_texts_cache
+             WHERE server = ? AND viewer = ? AND persno = ? AND global > ?
+                   AND local <= ?
+          ORDER BY {'local DESC' if newest_first else 'global'}''',
+                       (self.server, self.viewer, persno, after,
+                        sys.maxsize if last is None else last))
+        res = cursor.fetchall()
+        if res:
+            return [row[0] for row in res]
+        return []
+
+    def add_created_texts(self, persno: int,
+                          mct: list[tuple[int, int]]) -> None:
+        """Add a list of created local/global tuples to cache."""
+
+        self.write_many('''
+            INSERT OR REPLACE INTO created_texts_cache
+                            VALUES (?, ?, ?, ?, ?)''',
+                        ((self.server, self.viewer, persno, e[0], e[1])
+                         for e in mct))
+
+    def saved_searches(self) -> list[tuple[str, str, int, int]]:
+        """Get the name, options, highest textno searched and number of
+        lines found of each saved search."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+              SELECT name, options, checked,
+                     (SELECT count(*)
+                        FROM saved_match_cache AS m
+                       WHERE m.server = s.server AND m.viewer = s.viewer
+                             AND m.name = s.name)
+                FROM saved_search_cache AS s
+               WHERE server = ? AND viewer = ?
+            ORDER BY name''', (self.server, self.viewer))
+        return cursor.fetchall()
+
+    def saved_search(self, name: str) -> tuple[str, int] | None:
+        """Get the options of a saved search and the highest textno
+        searched."""
+
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            SELECT options, checked
+              FROM saved_search_cache
+             WHERE server = ? AND viewer = ? AND name = ?''',
+                       (self.server, self.viewer, name))
+        return cursor.fetchone()
+
+    def saved_matches(self, name: str, newest_first: bool) -> list[str]:
+        """Get the lines found by a saved search, the lines found by
+        the latest search first if newest_first is set."""
+
+        cursor = self.conn.cursor()
+        cursor.execute(f'''
+              SELECT line
+                FROM saved_match_cache
+               WHERE server = ? AND viewer = ? AND name = ?
+            ORDER BY checked {'DESC' if newest_first else ''}, rowid''',
+                       (self.server, self.viewer, name))
+        return [row[0] for row in cursor.fetchall()]
+
+    def save_search(self, name: str, options: str, checked: int,
+                    lines: list[tuple[int, str]]) -> None:
+        """Save a search up to textno checked, adding the lines found."""
+
+        self.write('''
+            INSERT OR REPLACE INTO saved_search_cache
+                 VALUES (?, ?, ?, ?, ?)''',
+                   (self.server, self.viewer, name, options, checked))
+        self.write_many('''
+            INSERT INTO saved_match_cache
+                 VALUES (?, ?, ?, ?, ?, ?)''',
+                        ((self.server, self.viewer, name, checked, textno,
+                          line) for textno, line in lines))
+        self.commit()
+
+    def delete_saved_search(self, name: str) -> None:
+        """Delete a saved search and the lines it found."""
+
+        for table in ('saved_search_cache', 'saved_match_cache'):
+            self.write(f'''
+                DELETE FROM {table}
+                      WHERE server = ? AND viewer = ? AND name = ?''',
+                       (self.server, self.viewer, name))
+        self.commit()
+
+
+class Matcher:
+    """Find the lines of texts that match a regular expression.
+
+    The output is that of re.findall(f'.*{pattern}.*'), but the pattern
+    is compiled once and searched for on its own, so lines without a
+    match cost no backtracking over .* at every position.  Only a line
+    that has a match is matched with the surrounding .* to get exactly
+    what findall would return.  If every match starts with a literal
+    string, texts without it are skipped with str.find.
+
+    Given the server's collate table, each literal character of the
+    pattern, alone or in a set, also matches the characters the table
+    considers equal to it.  The texts are searched as they are, so word
+    boundaries and classes like digits keep their meaning.
+    """
+
+    def __init__(self, pattern: str, flags: int = 0,
+                 collate: bytes | None = None):
+        self.pattern = pattern
+        self.flags = flags
+        self.fold: dict[int, int] = {}
+        if collate is not None:
+            self.fold = {i: norm for i, norm in enumerate(collate[:256])
+                         if i != norm and ord('\n') not in (i, norm)}
+        self.fold_bytes = bytes(self.fold.get(i, i) for i in range(256))
+        # The characters equal to each character, itself included
+        self.classes: dict[int, list[int]] = {}
+        for char, norm in self.fold.items():
+            self.classes.setdefault(norm, [norm]).append(char)
+        for chars in list(self.classes.values()):
+            for char in chars:
+                self.classes[char] = chars
+        self.regex = self.compile(pattern)
+        self.prefix = ''.join(itertools.takewhile(
+            lambda char: ord(char) not in self.classes,
+            self.literal_prefix(pattern, flags)))
+        self._line_regex: re.Pattern | None = None
+
+    @property
+    def line_regex(self) -> re.Pattern:
+        """The pattern with .* around it, compiled when first needed."""
+
+        if self._line_regex is None:
+            self._line_regex = self.compile(f'.*{self.pattern}.*')
+        return self._line_regex
+
+    def compile(self, pattern: str) -> re.Pattern:
+        """Compile pattern, its literal characters matching their
+        equals."""
+
+        if not self.classes:
+            return re.compile(pattern, self.flags)
+        parsed = sre_parse.parse(pattern, self.flags)
+        self.fold_pattern(parsed)
+        return sre_compile.compile(parsed, self.flags)
+
+    def fold_pattern(self, parsed: typing.Any) -> None:
+        """Let the literal characters of a parsed pattern match their
+        equals, in place."""
+
+        for i, (op, arg) in enumerate(parsed.data):
+            if op is sre_parse.LITERAL and arg in self.classes:
+                parsed.data[i] = (sre_parse.IN,
+                                  [(sre_parse.LITERAL, char)
+                                   for char in self.classes[arg]])
+            elif op is sre_parse.NOT_LITERAL and arg in self.classes:
+                parsed.data[i] = (sre_parse.IN,
+                                  [(sre_parse.NEGATE, None)]
+                                  + [(sre_parse.LITERAL, char)
+                                     for char in self.classes[arg]])
+            elif op is sre_parse.IN:
+                parsed.data[i] = (op, self.fold_set(arg))
+            else:
+                todo = [arg]
+                while todo:
+                    item = todo.pop()
+                    if isinstance(item, sre_parse.SubPattern):
+                        self.fold_pattern(item)
+                    elif isinstance(item, (tuple, list)):
+                        todo.extend(item)
+
+    def fold_set(self, items: list[tuple[typing.Any, typing.Any]]) \
+            -> list[tuple[typing.Any, typing.Any]]:
+        """Add the equals of the characters of a set, like [a-z]."""
+
+        equals: set[int] = set()
+        for op, arg in items:
+            if op is sre_parse.LITERAL:
+                equals.update(self.classes.get(arg, ()))
+            elif op is sre_parse.RANGE and arg[0] < 256:
+                for char in range(arg[0], min(arg[1], 255) + 1):
+                    equals.update(self.classes.get(char, ()))
+        return items + [(sre_parse.LITERAL, char) for char in sorted(equals)]
+
+    def folded(self, text: str) -> str:
+        """Get text folded through the collate table, as KeywordMatcher
+        searches it."""
+
+        try:
+            return text.encode('latin1').translate(self.fold_bytes) \
+                                        .decode('latin1')
+        except UnicodeEncodeError:
+            return text.translate(self.fold)
+
+    @staticmethod
+    def has_groups(pattern: str, flags: int) -> bool:
+        """Does pattern have groups, numbered or named?"""
+
+        return sre_parse.parse(pattern, flags).state.groups > 1
+
+    @staticmethod
+    def literal_prefix(pattern: str, flags: int) -> str:
+        """Get the literal string every match of pattern starts with."""
+
+        try:
+            parsed = sre_parse.parse(pattern, flags)
+        except re.error:
+            return ''
+        if parsed.state.flags & re.IGNORECASE:
+            return ''
+        prefix = []
+        for op, arg in parsed:
+            if op is not sre_parse.LITERAL:
+                break
+            prefix.append(chr(arg))
+        return ''.join(prefix)
+
+    @staticmethod
+    def line_of(line: re.Match, text: str) -> typing.Any:
+        """Get what findall would return for a match, from text."""
+
+        if line.re.groups == 0:
+            return text[line.start():line.end()]
+        if line.re.groups == 1:
+            return text[slice(*line.span(1))]
+        return tuple(text[slice(*line.span(group))]
+                     for group in range(1, line.re.groups + 1))
+
+    def findall(self, text: str) -> list[typing.Any]:
+        """Get the matching lines of text, as re.findall would."""
+
+        return [found for found, _, _, _, _ in self.find_lines(text)]
+
+    def find_lines(self, text: str) \
+            -> list[tuple[typing.Any, int, int, int, int]]:
+        """Get what findall would return for each matching line, with
+        where the line starts and ends and where the first match in it
+        starts and ends."""
+
+        if self.regex.flags & re.DOTALL:
+            # .* crosses lines, there is no line to find
+            return self.find_all_lines(text)
+        end = 0
+        if (pos := text.find(self.prefix)) < 0:
+            return []
+        lines = []
+        while match := self.regex.search(text, pos):
+            start = max(text.rfind('\n', 0, match.start()) + 1, end)
+            line = self.line_regex.match(text, start)
+            if line is None or line.start() == line.end():
+                # Empty matches advance differently, leave them to re
+                return self.find_all_lines(text)
+            lines.append((self.line_of(line, text), line.start(), line.end(),
+                          match.start(), min(match.end(), line.end())))
+            pos = end = line.end()
+        return lines
+
+    def find_all_lines(self, text: str) \
+            -> list[tuple[typing.Any, int, int, int, int]]:
+        """Like find_lines, leaving the lines to re.finditer."""
+
+        lines = []
+        for line in self.line_regex.finditer(text):
+            match = self.regex.search(text, line.start(), line.end())
+            lines.append((self.line_of(line, text), *line.span(),
+                          *(match or line).span()))
+        return lines
+
+
+class PatternsMatcher:
+    """Find the lines of texts that match any of several patterns.
+
+    Joined as alternatives, the groups of the patterns would be numbered
+    across all of them, breaking backreferences and repeated group
+    names, so each pattern is searched for on its own.  A line matching
+    several patterns is reported as the pattern matching first in it
+    finds it, the first given winning ties.
+    """
+
+    def __init__(self, matchers: list[Matcher]):
+        self.matchers = matchers
+
+    def findall(self, text: str) -> list[typing.Any]:
+        """Get the lines of text matching any pattern."""
+
+        return [found for found, _, _, _, _ in self.find_lines(text)]
+
+    def find_lines(self, text: str) \
+            -> list[tuple[typing.Any, int, int, int, int]]:
+        """Get the lines like Matcher.find_lines."""
+
+        lines: dict[int, tuple[typing.Any, int, int, int, int]] = {}
+        for matcher in self.matchers:
+            for line in matcher.find_lines(text):
+                if line[1] not in lines or line[3] < lines[line[1]][3]:
+                    lines[line[1]] = line
+        return [lines[start] for start in sorted(lines)]
+
+
+class KeywordMatcher:
+    """Find the lines of texts that contain any of a set of strings.
+
+    An Aho-Corasick automaton finds all the strings in one pass over a
+    text, however many there are.  While no string is partly matched, a
+    character class of the first characters of the strings skips ahead
+    to where one can start.  The output is that of Matcher given the
+    escaped strings as alternatives.
+    """
+
+    def __init__(self, keywords: list[str], ignore_case: bool = False,
+                 collate: bytes | None = None):
+        self.ignore_case = ignore_case
+        self.fallback = Matcher(f'(?:{"|".join(map(re.escape, keywords))})',
+                                re.I if ignore_case else 0,
+                                collate if ignore_case else None)
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail = [0]
+        self.final = [False]
+        for keyword in keywords:
+            self.add(self.casefold(keyword) if ignore_case else keyword)
+        self.link()
+        first = ''.join(self.goto[0])
+        self.skip = re.compile(f'[{re.escape(first)}]' if first else '(?!)')
+
+    def add(self, keyword: str) -> None:
+        """Add a string to the trie."""
+
+        state = 0
+        for char in keyword:
+            if char not in self.goto[state]:
+                self.goto[state][char] = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.final.append(False)
+            state = self.goto[state][char]
+        self.final[state] = True
+
+    def link(self) -> None:
+        """Add the failure links, breadth first."""
+
+        states = collections.deque(self.goto[0].values())
+        while states:
+            state = states.popleft()
+            for char, child in self.goto[state].items():
+                states.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.final[child] |= self.final[self.fail[child]]
+
+    def casefold(self, text: str) -> str:
+        """Get text in lower case, folded by any collate table first."""
+
+        if self.fallback.fold:
+            text = self.fallback.folded(text)
+        return text.lower()
+
+    def findall(self, text: str) -> list[typing.Any]:
+        """Get the lines of text with any of the strings in them."""
+
+        return [found for found, _, _, _, _ in self.find_lines(text)]
+
+    def find_lines(self, text: str) \
+            -> list[tuple[typing.Any, int, int, int, int]]:
+        """Get the lines like Matcher.find_lines.
+
+        The first string in a line is found with the regular expression,
+        as only where the strings end is known here.
+        """
+
+        if self.final[0]:
+            # The empty string matches everywhere, leave it to re
+            return self.fallback.find_lines(text)
+        folded = text
+        if self.ignore_case \
+           and len(folded := self.casefold(text)) != len(text):
+            return self.fallback.find_lines(text)
+        goto, fail, final = self.goto, self.fail, self.final
+        matches = []
+        state = 0
+        pos = 0
+        while pos < len(folded):
+            if state == 0:
+                if not (skip := self.skip.search(folded, pos)):
+                    break
+                pos = skip.start()
+            char = folded[pos]
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if final[state]:
+                start = text.rfind('\n', 0, pos) + 1
+                if (pos := text.find('\n', pos)) < 0:
+                    pos = len(text)
+                match = self.fallback.regex.search(text, start, pos)
+                matches.append((text[start:pos], start, pos,
+                                *(match.span() if match else (start, pos))))
+                state = 0
+            pos += 1
+        return matches
+
+
+def compile_patterns(patterns: list[str], ignore_case: bool = False,
+                     fixed_strings: bool = False,
+                     collate: bytes | None = None) \
+        -> Matcher | KeywordMatcher | PatternsMatcher:
+    """Get a matcher for lines matching any of the patterns.
+
+    Patterns without groups are joined as alternatives, to search for
+    them all at once.
+    """
+
+    flags = 0
+    if ignore_case:
+        flags = re.I
+    else:
+        collate = None
+    if fixed_strings:
+        return KeywordMatcher(patterns, ignore_case, collate)
+    if len(patterns) == 1:
+        return Matcher(patterns[0], flags, collate)
+    if any(Matcher.has_groups(pattern, flags) for pattern in patterns):
+        return PatternsMatcher([Matcher(pattern, flags, collate)
+                                for pattern in patterns])
+    return Matcher('(?:' + '|'.join(f'(?:{pattern})' for pattern in patterns)
+                   + ')', flags, collate)
+
+
+class Stage:
+    """A step of the search pipeline, counting what passes through it.
+
+    Items are pulled through the stages one at a time, so the time
+    spent getting an item includes the stages before this one, which
+    own_time subtracts.
+    """
+
+    def __init__(self, name: str, items: typing.Iterator[typing.Any],
+                 upstream: 'Stage | None' = None):
+        self.name = name
+        self.items = items
+        self.upstream = upstream
+        self.count = 0
+        self.elapsed = 0.0
+
+    def __iter__(self) -> 'Stage':
+        return self
+
+    def __next__(self) -> typing.Any:
+        start = time.perf_counter()
+        try:
+            item = next(self.items)
+        finally:
+            self.elapsed += time.perf_counter() - start
+        self.count += 1
+        return item
+
+    def own_time(self) -> float:
+        """Seconds spent in this stage alone."""
+
+        if self.upstream is None:
+            return self.elapsed
+        return self.elapsed - self.upstream.elapsed
+
+    def close(self) -> None:
+        """Stop the stage, letting a generator clean up."""
+
+        if isinstance(self.items, types.GeneratorType):
+            self.items.close()
+
+
+class TextSet(collections.abc.Sequence):
+    """An immutable set of text numbers, kept as a sorted array.
+
+    Takes four bytes a text instead of a set entry and an int object.
+    A much smaller set is intersected by searching the larger one for
+    each of its texts, starting where the last search ended, and sets
+    of similar size a block at a time.  Sets are sliced by position
+    like the list they are.
+    """
+
+    typecode = 'I'
+    gallop_ratio = 16
+    block_size = 4096
+
+    def __init__(self, texts: typing.Iterable[int] = ()):
+        if isinstance(texts, TextSet):
+            self.texts = texts.texts
+            return
+        self.texts = array.array(self.typecode, texts)
+        if not all(map(operator.lt, self.texts,
+                       itertools.islice(self.texts, 1, None))):
+            self.texts = array.array(self.typecode, sorted(set(self.texts)))
+
+    @classmethod
+    def from_sorted(cls, texts: array.array) -> 'TextSet':
+        """Make a set of an array already sorted without duplicates."""
+
+        textset = cls.__new__(cls)
+        textset.texts = texts
+        return textset
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @typing.overload
+    def __getitem__(self, index: int) -> int: ...
+
+    @typing.overload
+    def __getitem__(self, index: slice) -> 'TextSet': ...
+
+    def __getitem__(self, index: int | slice) -> 'int | TextSet':
+        if isinstance(index, slice):
+            return self.from_sorted(self.texts[index])
+        return self.texts[index]
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return iter(self.texts)
+
+    def __reversed__(self) -> typing.Iterator[int]:
+        return reversed(self.texts)
+
+    def __contains__(self, text_no: object) -> bool:
+        if not isinstance(text_no, int):
+            return False
+        i = bisect.bisect_left(self.texts, text_no)
+        return i < len(self.texts) and self.texts[i] == text_no
+
+    def __repr__(self) -> str:
+        return f'TextSet({self.texts.tolist()!r})'
+
+    def intersection(self, other: 'TextSet') -> 'TextSet':
+        """Texts in both sets."""
+
+        small, large = sorted((self.texts, other.texts), key=len)
+        result = array.array(self.typecode)
+        lo = 0
+        if len(small) * self.gallop_ratio < len(large):
+            end = len(large)
+            for text_no in small:
+                lo = bisect.bisect_left(large, text_no, lo)
+                if lo == end:
+                    break
+                if large[lo] == text_no:
+                    result.append(text_no)
+        else:
+            # Sets of similar size: intersect a block at a time with
+            # the part of the other set it spans
+            for start in range(0, len(small), self.block_size):
+                block = small[start:start + self.block_size]
+                lo = bisect.bisect_left(large, block[0], lo)
+                hi = bisect.bisect_right(large, block[-1], lo)
+                result.extend(sorted(set(block).intersection(large[lo:hi])))
+                lo = hi
+        return self.from_sorted(result)
+
+    def union(self, other: 'TextSet') -> 'TextSet':
+        """Texts in either set."""
+
+        return self.from_sorted(array.array(
+            self.typecode, (text_no for text_no, _
+                            in itertools.groupby(heapq.merge(self.texts,
+                                                             other.texts)))))
+
+
+class PlannedSource(typing.NamedTuple):
+    """A way to select texts, as seen by the planner.
+
+    size estimates how many texts it selects and uncached how many of
+    them are missing from the cached mapping.  The texts can be
+    streamed in order, fetched as a set, or, unless check is None,
+    checked one at a time against their textstats.  ordered tells if
+    they are streamed in order of creation.
+    """
+    description: str
+    size: int
+    uncached: int
+    stream: typing.Callable[[bool], typing.Iterator[int]]
+    fetch: typing.Callable[[], TextSet]
+    check: typing.Callable[[TextStat], bool] | None
+    ordered: bool = True
+
+
+class Textlist:
+    """A container class for managing lists of texts."""
+
+    mapping_block = 255
+
+    def __init__(self, conn: kom.CachedUserConnection, verbose: bool,
+                 cache_file: str | None = None,
+                 recheck_after: float = 30 * 24 * 3600,
+                 content_store: str | None = None):
+        self.conn = conn
+        self._verbose = verbose
+        self.recheck_after = recheck_after
+        self.clear()
+        self.cache = Cache(conn.host, conn.port, conn.get_user(), cache_file,
+                           content_store)
+
+    def clear(self) -> None:
+        """Forget the texts to search and the statistics, to search
+        again."""
+
+        self._reverse = False
+        self.textset = TextSet()
+        self.restricted = False
+        self.checks: list[typing.Callable[[TextStat], bool]] = []
+        self.planned: list[PlannedSource] = []
+        self.source: typing.Iterable[int] | None = None
+        self.ordered = False
+        self.period: range | None = None
+        self.since: float | None = None
+        self.before: float | None = None
+        self.after = 0
+        self.highest_searched = 0
+        self.statistics = {'textstat': {'hits': 0, 'misses': 0},
+                           'text': {'hits': 0, 'misses': 0},
+                           'deleted': {'hits': 0, 'misses': 0}}
+
+    def verbose(self, message: str):
+        """Print message if verbose flag is set."""
+        if self._verbose:
+            print(message)
+
+    def graceful(self, signal_received: int,
+                 _: types.FrameType | None) -> None:
+        """Commit cache and exit gracefully."""
+
+        self.cache.commit()
+        self.verbose_statistics()
+        print('Exiting on command')
+        sys.exit(signal_received != signal.SIGINT)
+
+    def is_empty(self) -> bool:
+        """Is this list empty?"""
+
+        return len(self.textset) == 0
+
+    def raise_if_empty(self) -> None:
+        """Raise an error if there is nothing to search."""
+
+        if (self.source is None or self.restricted) and self.is_empty():
+            raise EmptyListError
+
+    def reverse(self) -> None:
+        """Reverse this list."""
+
+        self._reverse = not self._reverse
+
+    def restrict(self, texts: TextSet) -> None:
+        """Restrict this list to texts, or start it if it is empty."""
+
+        if not self.restricted:
+            self.textset = texts
+            self.restricted = True
+        else:
+            self.textset = self.textset.intersection(texts)
+
+    def between(self, since: float | None, before: float | None) -> None:
+        """Only search texts created in the given period."""
+
+        self.since = since
+        self.before = before
+
+    def newer_than(self, text_no: int) -> None:
+        """Only search texts with higher numbers than text_no, like those
+        created since a search that went up to text_no."""
+
+        self.after = self.highest_searched = text_no
+
+    def get_textnos_in_conf(self, conf_no: int) -> None:
+        """Get all textnos for conference."""
+
+        self.restrict(self.fetch_textnos_in_conf(conf_no))
+
+    def fetch_textnos_in_conf(self, conf_no: int,
+                              conf: kom.Conference | None = None,
+                              uconf: kom.UConference | None = None) \
+            -> TextSet:
+        """Fetch all textnos for conference, updating the cache."""
+
+        return TextSet(self.iter_textnos_in_conf(conf_no, newest_first=False,
+                                                 conf=conf, uconf=uconf))
+
+    def fetch_textnos_in_confs(self, conf_nos: typing.Iterable[int],
+                               window: int) -> TextSet:
+        """Fetch all textnos for several conferences, updating the cache.
+
+        The mappings are fetched side by side: up to window requests are
+        kept outstanding, and the next block of a conference is requested
+        as soon as the previous one has arrived.  Texts sent to several
+        of the conferences are only included once.
+        """
+
+        conf_nos = list(dict.fromkeys(conf_nos))
+        texts = array.array(TextSet.typecode)
+        stat_reqs = []
+        for conf_no in conf_nos:
+            texts.extend(text_no for text_no
+                         in self.cache.global_text_list(
+                             conf_no, after=self.after) if text_no)
+            conf_req = None
+            if (last := self.cache.last_local(conf_no)) is None:
+                conf_req = kom.ReqGetConfStat(self.conn, conf_no)
+            stat_reqs.append((conf_no, last, conf_req,
+                              kom.ReqGetUconfStat(self.conn, conf_no)))
+
+        todo: collections.deque[tuple[int, int, int]] = collections.deque()
+        for conf_no, last, conf_req, uconf_req in stat_reqs:
+            if conf_req is not None:
+                last = conf_req.response().first_local_no - 1
+            ceiling = uconf_req.response().highest_local_no + 1
+            if last + 1 < ceiling:
+                todo.append((conf_no, last + 1, ceiling))
+
+        self.fetch_mappings(todo, kom.ReqLocalToGlobal,
+                            self.cache.add_local_to_global, window, texts)
+        return TextSet(texts)
+
+    def fetch_textnos_by_authors(self, pers_nos: typing.Iterable[int],
+                                 window: int) -> TextSet:
+        """Fetch all textnos by several authors, updating the cache.
+
+        The mappings are fetched side by side like in
+        fetch_textnos_in_confs.
+        """
+
+        pers_nos = list(dict.fromkeys(pers_nos))
+        texts = array.array(TextSet.typecode)
+        pers_reqs = []
+        for pers_no in pers_nos:
+            texts.extend(text_no for text_no
+                         in self.cache.created_text_list(
+                             pers_no, after=self.after) if text_no)
+            pers_reqs.append((pers_no, self.cache.last_created(pers_no),
+                              kom.ReqGetPersonStat(self.conn, pers_no)))
+
+        todo: collections.deque[tuple[int, int, int]] = collections.deque()
+        for pers_no, last, pers_req in pers_reqs:
+            pers = pers_req.response()
+            if last is None:
+                last = pers.first_created_local_no - 1
+            ceiling = pers.first_created_local_no + pers.no_of_created_texts
+            if last + 1 < ceiling:
+                todo.append((pers_no, last + 1, ceiling))
+
+        self.fetch_mappings(todo, kom.ReqMapCreatedTexts,
+                            self.cache.add_created_texts, window, texts)
+        return TextSet(texts)
+
+    def fetch_mappings(self, todo: collections.deque[tuple[int, int, int]],
+                       request: typing.Callable[..., typing.Any],
+                       store: typing.Callable[[int, list[tuple[int, int]]],
+                                              None],
+                       window: int, texts: array.array) -> None:
+        """Fetch mappings from local numbers, several at a time.
+
+        todo holds the conference or person, the first local number and
+        the local number after the last for each mapping.  Up to window
+        requests are kept outstanding, and the next block of a mapping
+        is requested as soon as the previous one has arrived.  The
+        mappings are stored and their texts added to texts.
+        """
+
+        pending: collections.deque[tuple[int, int, typing.Any]] = \
+            collections.deque()
+        while todo or pending:
+            while todo and len(pending) < window:
+                no, start, ceiling = todo.popleft()
+                pending.append((no, ceiling, request(self.conn,
+                                                     no,
+                                                     start,
+                                                     self.mapping_block)))
+            no, ceiling, req = pending.popleft()
+            mapping = req.response()
+            store(no, mapping.list)
+            texts.extend(text_no for _, text_no in mapping.list if text_no)
+            if mapping.later_texts_exists and mapping.range_end < ceiling:
+                todo.append((no, mapping.range_end, ceiling))
+
+    def stream_from(self, text_nos: typing.Iterable[int],
+                    ordered: bool = False) -> None:
+        """Search text_nos in the order given.
+
+        If the list has been restricted as well, only the texts in both
+        are searched.  Set ordered if the texts come in order of
+        creation, to stop at the end of the period.
+        """
+
+        self.source = text_nos
+        self.ordered = ordered
+
+    def iter_textnos_in_conf(self, conf_no: int,
+                             newest_first: bool = True,
+                             conf: kom.Conference | None = None,
+                             uconf: kom.UConference | None = None) \
+            -> typing.Iterator[int]:
+        """Yield the textnos of a conference.
+
+        Texts newer than the cached mapping are fetched from the server
+        a block at a time as they are consumed.  Oldest first, the
+        fetched blocks are cached at once.  Newest first, they are
+        fetched backwards, so the first ones come at once however large
+        the conference is, and only cached once they reach down to the
+        cached ones, as the cache resumes after its highest local number.
+        Only the cached texts up to that number are read from the cache,
+        so that texts another process, or the writer thread, adds
+        meanwhile are not yielded twice.  The conference status is
+        requested unless conf and uconf are given.
+        """
+
+        if (last := self.cache.last_local(conf_no)) is None:
+            if conf is None:
+                conf = kom.ReqGetConfStat(self.conn, conf_no).response()
+            last = conf.first_local_no - 1
+        if uconf is None:
+            uconf = kom.ReqGetUconfStat(self.conn, conf_no).response()
+        ceiling = uconf.highest_local_no + 1
+
+        if not newest_first:
+            yield from (text_no for text_no
+                        in self.cache.global_text_list(
+                            conf_no, after=self.after, last=last)
+                        if text_no)
+            start = last + 1
+            while start < ceiling:
+                ltg = kom.ReqLocalToGlobal(self.conn,
+                                           conf_no,
+                                           start,
+                                           self.mapping_block).response()
+                self.cache.add_local_to_global(conf_no, ltg.list)
+                yield from (text_no for _, text_no in ltg.list if text_no)
+                if not ltg.later_texts_exists:
+                    break
+                start = ltg.range_end
+            return
+
+        fetched: list[tuple[int, int]] = []
+        while ceiling > last + 1:
+            ltg = kom.ReqLocalToGlobalReverse(self.conn,
+                                              conf_no,
+                                              ceiling,
+                                              self.mapping_block).response()
+            for local_no, text_no in reversed(ltg.list):
+                if local_no > last:
+                    fetched.append((local_no, text_no))
+                    if text_no:
+                        yield text_no
+            if not ltg.later_texts_exists:
+                break
+            ceiling = ltg.range_begin
+        self.cache.add_local_to_global(conf_no, fetched)
+        yield from self.cache.global_text_list(conf_no, newest_first=True,
+                                               after=self.after, last=last)
+
+    def iter_textnos_by_author(self, pers_no: int,
+                               newest_first: bool = True) \
+            -> typing.Iterator[int]:
+        """Yield the textnos by an author.
+
+        Fetched and cached like iter_textnos_in_conf.
+        """
+
+        pers = kom.ReqGetPersonStat(self.conn, pers_no).response()
+        if (last := self.cache.last_created(pers_no)) is None:
+            last = pers.first_created_local_no - 1
+        ceiling = pers.first_created_local_no + pers.no_of_created_texts
+
+        if not newest_first:
+            yield from (text_no for text_no
+                        in self.cache.created_text_list(
+                            pers_no, after=self.after, last=last)
+                        if text_no)
+            start = last + 1
+            while start < ceiling:
+                mct = kom.ReqMapCreatedTexts(self.conn,
+                                             pers_no,
+                                             start,
+                                             self.mapping_block).response()
+                self.cache.add_created_texts(pers_no, mct.list)
+                yield from (text_no for _, text_no in mct.list if text_no)
+                if not mct.later_texts_exists:
+                    break
+                start = mct.range_end
+            return
+
+        fetched: list[tuple[int, int]] = []
+        while ceiling > last + 1:
+            mct = kom.ReqMapCreatedTextsReverse(self.conn,
+                                                pers_no,
+                                                ceiling,
+                                                self.mapping_block).response()
+            for local_no, text_no in reversed(mct.list):
+                if local_no > last:
+                    fetched.append((local_no, text_no))
+                    if text_no:
+                        yield text_no
+            if not mct.later_texts_exists:
+                break
+            ceiling = mct.range_begin
+        self.cache.add_created_texts(pers_no, fetched)
+        yield from self.cache.created_text_list(pers_no, newest_first=True,
+                                                after=self.after, last=last)
+
+    def get_textnos_by_author(self, pers_no: int) -> None:
+        """Get all textnos by author."""
+
+        self.restrict(self.fetch_textnos_by_author(pers_no))
+
+    def fetch_textnos_by_author(self, pers_no: int) -> TextSet:
+        """Fetch all textnos by author, updating the cache."""
+
+        return TextSet(self.iter_textnos_by_author(pers_no,
+                                                   newest_first=False))
+
+    def get_all_marks(self) -> None:
+        """Get users all marked texts."""
+
+        self.restrict(self.fetch_marks())
+
+    def fetch_marks(self) -> TextSet:
+        """Fetch the texts marked by the user."""
+
+        marks = kom.ReqGetMarks(self.conn).response()
+        return TextSet(m.text_no for m in marks if m.text_no)
+
+    def conf_source(self, conf_no: int) -> PlannedSource:
+        """Plan for the texts in a conference."""
+
+        conf_req = kom.ReqGetConfStat(self.conn, conf_no)
+        uconf_req = kom.ReqGetUconfStat(self.conn, conf_no)
+        conf = conf_req.response()
+        uconf = uconf_req.response()
+        if (last := self.cache.last_local(conf_no)) is None:
+            last = conf.first_local_no - 1
+        return PlannedSource(
+            f'conference {conf_no}', conf.no_of_texts,
+            max(uconf.highest_local_no - last, 0),
+            lambda newest_first: self.iter_textnos_in_conf(
+                conf_no, newest_first, conf=conf, uconf=uconf),
+            lambda: self.fetch_textnos_in_conf(conf_no, conf=conf,
+                                               uconf=uconf),
+            lambda textstat: any(rcpt.conf_no == conf_no
+                                 for rcpt in textstat.recipients),
+            # By local number, which texts added later break
+            ordered=False)
+
+    def member_confs_source(self, window: int) -> PlannedSource:
+        """Plan for the texts in all conferences the user is a member of."""
+
+        conf_nos = self.conn.get_member_confs()
+        return self.confs_source(conf_nos,
+                                 f'{len(conf_nos)} member conferences',
+                                 window)
+
+    def confs_source(self, conf_nos: list[int], description: str,
+                     window: int) -> PlannedSource:
+        """Plan for the texts in any of several conferences.
+
+        Their mappings are fetched together, so this is never streamed
+        a block at a time.
+        """
+
+        conf_reqs = [(conf_no, kom.ReqGetConfStat(self.conn, conf_no))
+                     for conf_no in conf_nos]
+        size = uncached = 0
+        for conf_no, conf_req in conf_reqs:
+            conf = conf_req.response()
+            size += conf.no_of_texts
+            if (last := self.cache.last_local(conf_no)) is None:
+                last = conf.first_local_no - 1
+            uncached += max(conf.first_local_no + conf.no_of_texts - 1
+                            - last, 0)
+        confs = set(conf_nos)
+
+        def stream(newest_first: bool) -> typing.Iterator[int]:
+            texts = self.fetch_textnos_in_confs(conf_nos, window)
+            return reversed(texts) if newest_first else iter(texts)
+
+        return PlannedSource(
+            description, size, uncached, stream,
+            lambda: self.fetch_textnos_in_confs(conf_nos, window),
+            lambda textstat: any(rcpt.conf_no in confs
+                                 for rcpt in textstat.recipients))
+
+    def authors_source(self, pers_nos: list[int],
+                       window: int) -> PlannedSource:
+        """Plan for the texts by any of several authors.
+
+        Fetched together like confs_source.
+        """
+
+        pers_reqs = [(pers_no, kom.ReqGetPersonStat(self.conn, pers_no))
+                     for pers_no in pers_nos]
+        size = uncached = 0
+        for pers_no, pers_req in pers_reqs:
+            pers = pers_req.response()
+            size += pers.no_of_created_texts
+            if (last := self.cache.last_created(pers_no)) is None:
+                last = pers.first_created_local_no - 1
+            uncached += max(pers.first_created_local_no
+                            + pers.no_of_created_texts - 1 - last, 0)
+        authors = set(pers_nos)
+
+        def stream(newest_first: bool) -> typing.Iterator[int]:
+            texts = self.fetch_textnos_by_authors(pers_nos, window)
+            return reversed(texts) if newest_first else iter(texts)
+
+        return PlannedSource(
+            f'{len(pers_nos)} authors', size, uncached, stream,
+            lambda: self.fetch_textnos_by_authors(pers_nos, window),
+            lambda textstat: textstat.author in authors)
+
+    def author_source(self, pers_no: int) -> PlannedSource:
+        """Plan for the texts by an author."""
+
+        pers = kom.ReqGetPersonStat(self.conn, pers_no).response()
+        if (last := self.cache.last_created(pers_no)) is None:
+            last = pers.first_created_local_no - 1
+        return PlannedSource(
+            f'author {pers_no}', pers.no_of_created_texts,
+            max(pers.first_created_local_no + pers.no_of_created_texts
+                - 1 - last, 0),
+            lambda newest_first: self.iter_textnos_by_author(pers_no,
+                                                             newest_first),
+            lambda: self.fetch_textnos_by_author(pers_no),
+            lambda textstat: textstat.author == pers_no)
+
+    def marks_source(self) -> PlannedSource:
+        """Plan for the texts marked by the user.
+
+        The marks come in a single request, so they are fetched at once.
+        """
+
+        marks = self.fetch_marks()
+        return PlannedSource(
+            'marked texts', len(marks), 0,
+            lambda newest_first: reversed(marks) if newest_first
+            else iter(marks),
+            lambda: marks,
+            None)
+
+    def unread_source(self, conf_nos: list[int] | None) -> PlannedSource:
+        """Plan for the texts the user has not read.
+
+        The texts outside the read ranges of the given conferences, or
+        of all member conferences, are few and fetched at once.  A new
+        text is unread if it is in one of those conferences, which is
+        what is checked.
+        """
+
+        unread = self.conn.get_unread_texts_in_confs(conf_nos)
+        texts = TextSet(text_no for text_nos in unread.values()
+                        for text_no in text_nos if text_no)
+        confs = set(unread)
+        return PlannedSource(
+            'unread texts', len(texts), 0,
+            lambda newest_first: reversed(texts) if newest_first
+            else iter(texts),
+            lambda: texts,
+            lambda textstat: any(rcpt.conf_no in confs
+                                 for rcpt in textstat.recipients))
+
+    def plan(self, sources: list[PlannedSource], newest_first: bool) -> None:
+        """Search the texts selected by all sources.
+
+        The smallest source is streamed.  Each of the others is checked
+        text by text if that takes fewer textstats than the mapping
+        requests needed to fetch it, or if the textstats are needed for
+        the period anyway.  Otherwise it is fetched and intersected.  A
+        stream not in order of creation can not end at the period, so
+        then the driving source is fetched too and cut to the period by
+        binary search.  The fetched mappings are committed before the
+        stream reads the cache, so that it does not fetch them again.
+        """
+
+        self.planned = sources
+        if not sources:
+            return
+        driving = min(sources, key=lambda source: source.size)
+        self.verbose(f'streaming {driving.description},'
+                     f' about {driving.size} texts')
+        self.stream_from(driving.stream(newest_first), driving.ordered)
+        if not driving.ordered \
+           and (self.since is not None or self.before is not None):
+            self.verbose(f'fetching {driving.description} for the period')
+            self.period = self.period_range(driving.fetch())
+        for source in sources:
+            if source is driving:
+                continue
+            requests = -(-source.uncached // self.mapping_block)
+            if source.check is not None and source.uncached \
+               and (driving.size < requests
+                    or self.since is not None or self.before is not None):
+                self.verbose(f'checking {source.description} per text')
+                self.checks.append(source.check)
+            else:
+                self.verbose(f'intersecting with {source.description},'
+                             f' {requests} requests')
+                self.restrict(source.fetch())
+        if self.restricted or self.period is not None:
+            self.cache.commit()
+
+    def populate(self, conf_nos: list[int], author_nos: list[int],
+                 marked: bool = False, member_confs: bool = False,
+                 unread: bool = False, since: float | None = None,
+                 before: float | None = None, newest_first: bool = True,
+                 window: int = 32) -> None:
+        """Plan the texts to search: those in the conferences, by the
+        authors, marked, in the conferences we are members of, or
+        unread, in the period between since and before."""
+
+        if newest_first:
+            self.reverse()
+        self.between(since, before)
+        sources = []
+        if unread:
+            sources.append(self.unread_source(conf_nos or None))
+        elif len(conf_nos) == 1:
+            sources.append(self.conf_source(conf_nos[0]))
+        elif conf_nos:
+            sources.append(self.confs_source(
+                conf_nos, f'{len(conf_nos)} conferences', window))
+        if len(author_nos) == 1:
+            sources.append(self.author_source(author_nos[0]))
+        elif author_nos:
+            sources.append(self.authors_source(author_nos, window))
+        if member_confs:
+            sources.append(self.member_confs_source(window))
+        if marked:
+            sources.append(self.marks_source())
+        self.plan(sources, newest_first)
+        self.raise_if_empty()
+
+    def follow(self, search: typing.Callable[[], None]) -> None:
+        """Search new texts as they come, until interrupted.
+
+        The texts created, or sent to new recipients, are taken from
+        asynchronous messages.  Once the messages that have arrived are
+        handled, the list is set to the new texts that pass the checks
+        of all planned sources, and search is called.
+        """
+
+        new_texts: list[int] = []
+        new_recipients: list[int] = []
+
+        def new_text(msg: kom.AsyncMessage, _: kom.Connection) -> None:
+            assert isinstance(msg, kom.AsyncNewText)
+            self.cache.add_textstat(msg.text_no,
+                                    self.convert_textstat(msg.text_stat))
+            new_texts.append(msg.text_no)
+
+        def new_recipient(msg: kom.AsyncMessage, _: kom.Connection) -> None:
+            assert isinstance(msg, kom.AsyncNewRecipient)
+            new_recipients.append(msg.text_no)
+
+        self.conn.add_async_handler(kom.ASYNC_NEW_TEXT, new_text)
+        self.conn.add_async_handler(kom.ASYNC_NEW_RECIPIENT, new_recipient)
+        kom.ReqAcceptAsync(self.conn, [kom.ASYNC_NEW_TEXT,
+                                       kom.ASYNC_NEW_RECIPIENT]).response()
+        checks = [source.check for source in self.planned
+                  if source.check is not None]
+        while True:
+            # Messages may have been handled, or read, during the search
+            if not new_texts and not new_recipients \
+               and not self.conn.rb[self.conn.rb_pos:].strip():
+                select.select([self.conn.socket], [], [])
+                self.conn.parse_server_message()
+            while self.conn.rb[self.conn.rb_pos:].strip():
+                self.conn.parse_server_message()
+            # The recipients are only known from a new textstat
+            stat_reqs = [(text_no, kom.ReqGetTextStat(self.conn, text_no))
+                         for text_no in new_recipients]
+            new_recipients.clear()
+            for text_no, stat_req in stat_reqs:
+                if self.store_textstat(text_no, stat_req) is not None:
+                    new_texts.append(text_no)
+            if not new_texts:
+                continue
+            self.textset = TextSet()
+            self.restricted = False
+            self.period = None
+            self.checks = checks
+            self.stream_from(list(dict.fromkeys(new_texts)))
+            new_texts.clear()
+            search()
+
+    def get_textstat(self, text_no: int) -> TextStat:
+        """Get textstat for a text."""
+
+        if textstat := self.cache.textstat(text_no):
+            self.statistics['textstat']['hits'] += 1
+            return textstat
+        self.statistics['textstat']['misses'] += 1
+
+        stat = kom.ReqGetTextStat(self.conn, text_no).response()
+        textstat = self.convert_textstat(stat)
+        self.cache.add_textstat(text_no, textstat)
+        return textstat
+
+    @staticmethod
+    def convert_textstat(stat: kom.TextStat) -> TextStat:
+        """Convert a textstat from the server to its cached form."""
+
+        encoding = 'latin1'
+        for aux_item in stat.aux_items:
+            if aux_item.tag == 1:  # content-type
+                for param in aux_item.data.split(';')[1:]:
+                    attr, value = param.strip().split('=')
+                    if attr == 'charset' and value not in ('us-ascii',
+                                                           'x-ctext'):
+                        encoding = value
+        return TextStat(stat.creation_time.to_python_time(), encoding,
+                        stat.author, stat.no_of_lines, stat.no_of_chars,
+                        tuple(Recipient(rcpt.recpt, rcpt.loc_no, rcpt.type)
+                              for rcpt in stat.misc_info.recipient_list),
+                        tuple(CommentLink(link.text_no, link.type)
+                              for link in stat.misc_info.comment_to_list))
+
+    def is_tombstoned(self, text_no: int) -> bool:
+        """Is the text cached as unavailable, and not due for a recheck?"""
+
+        if (tombstone := self.cache.tombstone(text_no)) is None:
+            return False
+        reason, checked = tombstone
+        if reason != Tombstone.DELETED \
+           and checked + self.recheck_after < time.time():
+            return False
+        self.statistics['deleted']['hits'] += 1
+        return True
+
+    def add_tombstone(self, text_no: int, reason: Tombstone) -> None:
+        """Cache a text as unavailable."""
+
+        self.statistics['deleted']['misses'] += 1
+        self.cache.add_tombstone(text_no, reason)
+
+    def get_text(self, text_no: int) -> str | None:
+        """Get text content."""
+
+        if (text := self.cache.content(text_no)) is not None:
+            self.statistics['text']['hits'] += 1
+            return text
+        if self.is_tombstoned(text_no):
+            return None
+        self.statistics['text']['misses'] += 1
+
+        try:
+            text = kom.ReqGetText(self.conn, text_no).response()
+        except kom.NoSuchText:
+            self.add_tombstone(text_no, Tombstone.NO_SUCH_TEXT)
+            return None
+        except (kom.AccessDenied, kom.PermissionDenied):
+            self.add_tombstone(text_no, Tombstone.ACCESS_DENIED)
+            return None
+
+        text = text.decode(self.get_textstat(text_no).encoding)
+        self.cache.add_content(text_no, text)
+        return text
+
+    def sync_texts(self, text_nos: typing.Iterable[int], window: int,
+                   batch: int) -> int:
+        """Fetch textstats and contents missing from the cache.
+
+        Up to window texts are requested before the first response is
+        read, and the cache is committed after every batch stored
+        texts.  Returns the number of texts fetched.
+        """
+
+        pending: collections.deque[tuple[int, kom.ReqGetTextStat | None,
+                                         kom.ReqGetText]] = \
+            collections.deque()
+        fetched = 0
+        for text_no in text_nos:
+            if self.cache.has_content(text_no) or self.is_tombstoned(text_no):
+                continue
+            stat_req = None
+            if self.cache.textstat(text_no) is None:
+                stat_req = kom.ReqGetTextStat(self.conn, text_no)
+            pending.append((text_no, stat_req,
+                            kom.ReqGetText(self.conn, text_no)))
+            if len(pending) >= window:
+                self.store_fetched(*pending.popleft())
+                fetched += 1
+                if fetched % batch == 0:
+                    self.cache.commit()
+                    self.verbose(f'{fetched} texts fetched')
+        while pending:
+            self.store_fetched(*pending.popleft())
+            fetched += 1
+        self.cache.commit()
+        return fetched
+
+    def fetch_texts(self, text_nos: typing.Iterable[int], window: int) \
+            -> typing.Iterator[tuple[int, str | None]]:
+        """Get the contents of texts in order, pipelining the fetches.
+
+        Up to window texts missing from the cache are requested before
+        the first response is read.  When the caller stops early, no
+        more requests are sent, and the responses to those already sent
+        are read and cached.
+        """
+
+        pending: collections.deque[tuple[int, str | None,
+                                         kom.ReqGetTextStat | None,
+                                         kom.ReqGetText | None]] = \
+            collections.deque()
+        requested = 0
+        try:
+            for text_no in text_nos:
+                if (text := self.cache.content(text_no)) is not None:
+                    self.statistics['text']['hits'] += 1
+                    pending.append((text_no, text, None, None))
+                elif self.is_tombstoned(text_no):
+                    pending.append((text_no, None, None, None))
+                else:
+                    stat_req = None
+                    if self.cache.textstat(text_no) is None:
+                        stat_req = kom.ReqGetTextStat(self.conn, text_no)
+                    pending.append((text_no, None, stat_req,
+                                    kom.ReqGetText(self.conn, text_no)))
+                    requested += 1
+                while pending and (pending[0][3] is None
+                                   or requested >= window):
+                    text_no, text, stat_req, text_req = pending.popleft()
+                    if text_req is not None:
+                        requested -= 1
+                        text = self.store_fetched(text_no, stat_req,
+                                                  text_req)
+                    yield text_no, text
+            while pending:
+                text_no, text, stat_req, text_req = pending.popleft()
+                if text_req is not None:
+                    text = self.store_fetched(text_no, stat_req, text_req)
+                yield text_no, text
+        finally:
+            for text_no, _, stat_req, text_req in pending:
+                if text_req is not None:
+                    self.store_fetched(text_no, stat_req, text_req)
+
+    def store_fetched(self, text_no: int,
+                      stat_req: kom.ReqGetTextStat | None,
+                      text_req: kom.ReqGetText) -> str | None:
+        """Read pipelined responses for a text and add them to the cache.
+
+        Returns the content, or None if the text could not be read.
+        """
+
+        self.statistics['text']['misses'] += 1
+        try:
+            if stat_req is not None:
+                self.statistics['textstat']['misses'] += 1
+                textstat = self.convert_textstat(stat_req.response())
+                self.cache.add_textstat(text_no, textstat)
+            else:
+                textstat = self.get_textstat(text_no)
+        except (kom.NoSuchText, kom.AccessDenied, kom.PermissionDenied):
+            textstat = None
+        try:
+            content = text_req.response()
+        except kom.NoSuchText:
+            self.add_tombstone(text_no, Tombstone.NO_SUCH_TEXT)
+            return None
+        except (kom.AccessDenied, kom.PermissionDenied):
+            self.add_tombstone(text_no, Tombstone.ACCESS_DENIED)
+            return None
+        if textstat is None:
+            return None
+        text = content.decode(textstat.encoding)
+        self.cache.add_content(text_no, text)
+        return text
+
+    def fetch_textstats(self, text_nos: typing.Iterable[int], window: int) \
+            -> typing.Iterator[tuple[int, TextStat | None]]:
+        """Get the textstats of texts in order, pipelining the fetches.
+
+        Like fetch_texts, with None for texts that cannot be read.
+        """
+
+        pending: collections.deque[tuple[int, TextStat | None,
+                                         kom.ReqGetTextStat | None]] = \
+            collections.deque()
+        requested = 0
+        try:
+            for text_no in text_nos:
+                if (textstat := self.cache.textstat(text_no)) is not None:
+                    self.statistics['textstat']['hits'] += 1
+                    pending.append((text_no, textstat, None))
+                else:
+                    pending.append((text_no, None,
+                                    kom.ReqGetTextStat(self.conn, text_no)))
+                    requested += 1
+                while pending and (pending[0][2] is None
+                                   or requested >= window):
+                    text_no, textstat, stat_req = pending.popleft()
+                    if stat_req is not None:
+                        requested -= 1
+                        textstat = self.store_textstat(text_no, stat_req)
+                    yield text_no, textstat
+            while pending:
+                text_no, textstat, stat_req = pending.popleft()
+                if stat_req is not None:
+                    textstat = self.store_textstat(text_no, stat_req)
+                yield text_no, textstat
+        finally:
+            for text_no, _, stat_req in pending:
+                if stat_req is not None:
+                    self.store_textstat(text_no, stat_req)
+
+    def store_textstat(self, text_no: int,
+                       stat_req: kom.ReqGetTextStat) -> TextStat | None:
+        """Read a pipelined textstat response and add it to the cache."""
+
+        self.statistics['textstat']['misses'] += 1
+        try:
+            textstat = self.convert_textstat(stat_req.response())
+        except (kom.NoSuchText, kom.AccessDenied, kom.PermissionDenied):
+            return None
+        self.cache.add_textstat(text_no, textstat)
+        return textstat
+
+    def first_created_at(self, texts: typing.Sequence[int],
+                         timestamp: float) -> int:
+        """Find the first of sorted texts created at timestamp or later."""
+
+        if not texts \
+           or self.get_textstat(texts[0]).creation_time >= timestamp:
+            return 0
+        if self.get_textstat(texts[-1]).creation_time < timestamp:
+            return len(texts)
+
+        left = 0
+        right = len(texts) - 1
+        while left < right:
+            i = left + (right - left) // 2
+            if self.get_textstat(texts[i]).creation_time >= timestamp:
+                right = i
+            else:
+                left = i + 1
+        return left
+
+    def period_range(self, texts: TextSet) -> range:
+        """Find the text numbers created in the period, given the texts
+        to search, as text numbers follow the order of creation."""
+
+        start = end = None
+        if self.since is not None \
+           and (i := self.first_created_at(texts, self.since)):
+            start = texts[i - 1] + 1
+        if self.before is not None \
+           and (i := self.first_created_at(texts, self.before)) < len(texts):
+            end = texts[i]
+        return range(start or 0, end or sys.maxsize)
+
+    def source_stage(self) -> typing.Iterator[int]:
+        """Yield the texts to search, in search order.
+
+        The list itself is only searched when there is no source to
+        stream from, and then cut to the period by binary search.  The
+        highest text number searched is kept in highest_searched.
+        """
+
+        if self.source is not None:
+            for text_no in self.source:
+                if text_no > self.after:
+                    if text_no > self.highest_searched:
+                        self.highest_searched = text_no
+                    yield text_no
+            return
+        texts = self.textset[bisect.bisect_right(self.textset, self.after):]
+        if self.since is not None:
+            texts = texts[self.first_created_at(texts, self.since):]
+        if self.before is not None:
+            texts = texts[:self.first_created_at(texts, self.before)]
+        self.verbose(f'{len(texts)} texts to search')
+        if texts:
+            self.highest_searched = max(self.highest_searched, texts[-1])
+        yield from reversed(texts) if self._reverse else texts
+
+    def filter_stage(self, text_nos: typing.Iterable[int], window: int) \
+            -> typing.Iterator[int]:
+        """Drop streamed texts outside the restricted list and period.
+
+        Streamed in order of creation, the stream ends at the first
+        text past the period, and if the period is known as a range of
+        text numbers, texts outside it are dropped without a textstat.
+        Texts failing a check on their textstat are dropped as well.
+        """
+
+        if self.source is None:
+            yield from text_nos
+            return
+        if self.restricted:
+            text_nos = (text_no for text_no in text_nos
+                        if text_no in self.textset)
+        since, before = self.since, self.before
+        if self.period is not None:
+            text_nos = (text_no for text_no in text_nos
+                        if text_no in self.period)
+            since = before = None
+        if since is None and before is None and not self.checks:
+            yield from text_nos
+            return
+
+        if self._reverse:
+            first, last = before, since
+        else:
+            first, last = since, before
+        with contextlib.closing(self.fetch_textstats(text_nos,
+                                                     window)) as textstats:
+            for text_no, textstat in textstats:
+                if textstat is None:
+                    continue
+                created = textstat.creation_time
+                if self._reverse:
+                    past = last is not None and created < last
+                    early = first is not None and created >= first
+                else:
+                    past = last is not None and created >= last
+                    early = first is not None and created < first
+                if past and self.ordered:
+                    return
+                if past or early:
+                    continue
+                if all(check(textstat) for check in self.checks):
+                    yield text_no
+
+    def decode_stage(self, texts: typing.Iterable[tuple[int, str | None]],
+                     include_subject: bool) \
+            -> typing.Iterator[tuple[int, str]]:
+        """Yield the searchable part of each readable text.
+
+        Texts are decoded as they are fetched, since that is how they
+        are cached, so this only drops the unreadable ones and the
+        subject lines.  The texts searched are marked as used in the
+        cache in batches.
+        """
+
+        searched: list[int] = []
+        try:
+            for text_no, text in texts:
+                if text is None:
+                    self.verbose(f'text {text_no} not found')
+                    continue
+                searched.append(text_no)
+                if len(searched) >= 1000:
+                    self.cache.touch(searched)
+                    searched = []
+                if not include_subject:
+                    text = text[text.find('\n'):]
+                yield text_no, text
+        finally:
+            self.cache.touch(searched)
+
+    def match_stage(self, texts: typing.Iterable[tuple[int, str]],
+                    matcher: 'Matcher | KeywordMatcher',
+                    max_per_text: int | None) \
+            -> typing.Iterator[list[Match]]:
+        """Yield the matching lines of the texts that match."""
+
+        for text_no, text in texts:
+            if lines := matcher.find_lines(text)[:max_per_text]:
+                textstat = self.get_textstat(text_no)
+                yield [Match(text_no, text.count('\n', 0, start) + 1,
+                             (match_start - start, match_end - start),
+                             text[start:end], found,
+                             textstat.creation_time, textstat.author)
+                       for found, start, end, match_start, match_end
+                       in lines]
+
+    @staticmethod
+    def output_stage(matches: typing.Iterable[Match],
+                     max_count: int | None, list_texts: bool,
+                     printed: list[tuple[int, str]] | None = None) \
+            -> typing.Iterator[Match]:
+        """Print matches, yielding each match printed.
+
+        Stops after max_count matching lines, or texts if list_texts is
+        set.  The lines printed are added to printed, if given.
+        """
+
+        found = 0
+        last = None
+        for match in matches:
+            if list_texts:
+                if match.text_no == last:
+                    continue
+                output = str(match.text_no)
+            else:
+                output = f'{match.text_no: >8} {match.found}'
+            last = match.text_no
+            print(output)
+            if printed is not None:
+                printed.append((match.text_no, output))
+            found += 1
+            yield match
+            if max_count is not None and found >= max_count:
+                return
+
+    def verbose_statistics(self) -> None:
+        """Print statistics if verbose flag is set."""
+        if self._verbose:
+            print('Cache Statistics:')
+            for stat, stats in self.statistics.items():
+                print(f' {stat:>8}'
+                      f' hits: {stats["hits"]:>6d}'
+                      f' misses: {stats["misses"]:>6d}')
+            print(f'Cached for {self.cache.host}:{self.cache.port}'
+                  f' in {self.cache.dbfile}:')
+            for table, count in self.cache.statistics().items():
+                print(f' {table:>16} {count:>8d}')
+
+    def search(self, patterns: list[str], include_subject: bool = False,
+               ignore_case: bool = False, fixed_strings: bool = False,
+               max_per_text: int | None = None, window: int = 32,
+               collate: bytes | None = None,
+               stages: list[Stage] | None = None) \
+            -> typing.Iterator[Match]:
+        """Search all texts in textlist, yielding the matching lines.
+
+        Texts are only fetched as the matches are asked for, so closing
+        the generator stops the search.  At most max_per_text lines of
+        each text are yielded.  Ignoring case, characters equal by the
+        collate table match each other.  The stages of the pipeline are
+        added to stages, if given.
+        """
+
+        matcher = compile_patterns(patterns, ignore_case, fixed_strings,
+                                   collate)
+        if stages is None:
+            stages = []
+        first = len(stages)
+
+        def stage(name: str, items: typing.Iterator[typing.Any]) -> Stage:
+            stages.append(Stage(name, items, stages[-1] if stages else None))
+            return stages[-1]
+
+        texts = stage('source', self.source_stage())
+        texts = stage('filter', self.filter_stage(texts, window))
+        texts = stage('fetch', self.fetch_texts(texts, window))
+        texts = stage('decode', self.decode_stage(texts, include_subject))
+        texts = stage('match', self.match_stage(texts, matcher,
+                                                max_per_text))
+        try:
+            for matches in texts:
+                yield from matches
+        finally:
+            for step in reversed(stages[first:]):
+                step.close()
+            self.cache.commit()
+
+    def grep(self, patterns: list[str], include_subject: bool,
+             ignore_case: bool, fixed_strings: bool = False,
+             max_count: int | None = None,
+             max_per_text: int | None = None,
+             list_texts: bool = False, window: int = 32,
+             collate: bytes | None = None,
+             printed: list[tuple[int, str]] | None = None) -> None:
+        """Grep through all texts in textlist, printing the matches.
+
+        Stops after max_count matching lines, or texts if list_texts is
+        set, printing at most max_per_text lines of each text.  The
+        lines printed are added to printed, if given.
+        """
+
+        if list_texts:
+            max_per_text = 1
+        stages: list[Stage] = []
+        matches = self.search(patterns, include_subject, ignore_case,
+                              fixed_strings, max_per_text, window, collate,
+                              stages)
+        output = Stage('output', self.output_stage(matches, max_count,
+                                                   list_texts, printed))
+        try:
+            for _ in output:
+                pass
+        finally:
+            output.close()
+            matches.close()
+        # The match stage only exists once the search has started
+        if stages:
+            output.upstream = stages[-1]
+            stages.append(output)
+        self.verbose_pipeline(stages)
+        self.verbose_statistics()
+
+    def verbose_pipeline(self, stages: list[Stage]) -> None:
+        """Print the throughput of each stage if verbose flag is set."""
+        if self._verbose:
+            print('Pipeline Statistics:')
+            for step in stages:
+                seconds = step.own_time()
+                rate = step.count / seconds if seconds > 0 else 0
+                print(f' {step.name:>8} {step.count:>8d} items'
+                      f' {seconds:>8.3f} s {rate:>10.0f}/s')
+
+
+class CacheWatcher:
+    """Keep the cache current from asynchronous messages."""
+
+    messages = [kom.ASYNC_NEW_TEXT, kom.ASYNC_DELETED_TEXT,
+                kom.ASYNC_NEW_RECIPIENT, kom.ASYNC_SUB_RECIPIENT,
+                kom.ASYNC_NEW_NAME]
+
+    def __init__(self, textlist: Textlist, window: int):
+        self.textlist = textlist
+        self.conn = textlist.conn
+        self.cache = textlist.cache
+        self.window = window
+        self.to_fetch: list[int] = []
+        self.to_stat: list[int] = []
+        self.conn.add_async_handler(kom.ASYNC_NEW_TEXT, self.new_text)
+        self.conn.add_async_handler(kom.ASYNC_DELETED_TEXT,
+                                    self.deleted_text)
+        self.conn.add_async_handler(kom.ASYNC_NEW_RECIPIENT,
+                                    self.new_recipient)
+        self.conn.add_async_handler(kom.ASYNC_SUB_RECIPIENT,
+                                    self.sub_recipient)
+        self.conn.add_async_handler(kom.ASYNC_NEW_NAME, self.new_name)
+
+    def add_mappings(self, text_no: int, stat: kom.TextStat) -> None:
+        """Add the local numbers of a text to the cached mappings.
+
+        A mapping is only extended when it already reaches the local
+        number just before the new one, as the cache resumes fetching
+        after its highest local number and would otherwise skip texts.
+        """
+
+        self.cache.commit()
+        for rcpt in stat.misc_info.recipient_list:
+            if self.cache.last_local(rcpt.recpt) == rcpt.loc_no - 1:
+                self.cache.add_local_to_global(rcpt.recpt,
+                                               [(rcpt.loc_no, text_no)])
+
+    def new_text(self, msg: kom.AsyncMessage, _: kom.Connection) -> None:
+        """Cache textstat and mappings of a new text, queue its content."""
+
+        assert isinstance(msg, kom.AsyncNewText)
+        self.textlist.verbose(f'new text {msg.text_no}')
+        self.cache.add_textstat(msg.text_no,
+                                self.textlist.convert_textstat(msg.text_stat))
+        self.add_mappings(msg.text_no, msg.text_stat)
+        self.to_fetch.append(msg.text_no)
+
+    def deleted_text(self, msg: kom.AsyncMessage, _: kom.Connection) -> None:
+        """Mark a deleted text as deleted in the cache."""
+
+        assert isinstance(msg, kom.AsyncDeletedText)
+        self.textlist.verbose(f'deleted text {msg.text_no}')
+        self.cache.add_tombstone(msg.text_no, Tombstone.DELETED)
+
+    def new_recipient(self, msg: kom.AsyncMessage,
+                      _: kom.Connection) -> None:
+        """Queue a text with a new recipient for a textstat refresh."""
+
+        assert isinstance(msg, kom.AsyncNewRecipient)
+        self.textlist.verbose(f'text {msg.text_no} added to {msg.conf_no}')
+        self.to_stat.append(msg.text_no)
+
+    def sub_recipient(self, msg: kom.AsyncMessage,
+                      _: kom.Connection) -> None:
+        """Remove a text from the cached mapping of a conference."""
+
+        assert isinstance(msg, kom.AsyncSubRecipient)
+        self.textlist.verbose(f'text {msg.text_no} removed from'
+                              f' {msg.conf_no}')
+        self.cache.remove_local_to_global(msg.conf_no, msg.text_no)
+
+    def new_name(self, msg: kom.AsyncMessage, _: kom.Connection) -> None:
+        """Change a name in the cached name directories."""
+
+        assert isinstance(msg, kom.AsyncNewName)
+        name = msg.new_name.decode('latin1')
+        self.textlist.verbose(f'{msg.conf_no} renamed to {name}')
+        self.cache.commit()
+        self.cache.rename(self.cache.server, msg.conf_no, name)
+
+    def process_queued(self) -> None:
+        """Fetch what the asynchronous messages asked for."""
+
+        while self.to_stat:
+            text_no = self.to_stat.pop(0)
+            try:
+                stat = kom.ReqGetTextStat(self.conn, text_no).response()
+            except kom.NoSuchText:
+                continue
+            self.cache.add_textstat(text_no,
+                                    self.textlist.convert_textstat(stat))
+            self.add_mappings(text_no, stat)
+        if self.to_fetch:
+            to_fetch, self.to_fetch = self.to_fetch, []
+            self.textlist.sync_texts(to_fetch, self.window, len(to_fetch))
+
+    def run(self, commit_interval: float,
+            server: socket.socket | None = None,
+            answer: typing.Callable[[socket.socket], None] | None = None) \
+            -> None:
+        """Handle asynchronous messages until interrupted.
+
+        Connections to server are accepted and given to answer in
+        between.
+        """
+
+        kom.ReqAcceptAsync(self.conn, self.messages).response()
+        sockets = [self.conn.socket]
+        if server is not None:
+            sockets.append(server)
+        while True:
+            readable, _, _ = select.select(sockets, [], [], commit_interval)
+            if server in readable and answer is not None:
+                answer(server.accept()[0])
+            if self.conn.socket in readable \
+               or self.conn.rb[self.conn.rb_pos:].strip():
+                self.conn.parse_server_message()
+                while self.conn.rb[self.conn.rb_pos:].strip():
+                    self.conn.parse_server_message()
+            self.process_queued()
+            self.cache.commit()
+            self.cache.enforce_max_size()
+
+
+class NameDirectory:
+    """Look up names in a directory of all names kept in the cache.
+
+    The directory is fetched with a single lookup of the empty name,
+    which matches every name, along with the collate table, and fetched
+    again when older than max_age.  Names are matched like the server
+    does: every word given must begin the corresponding word of the
+    name, both folded through the collate table and without
+    parenthesized words.  A name not in the directory, perhaps a new
+    one, is looked up on the server.
+    """
+
+    max_age = 24 * 3600
+
+    def __init__(self, dbfile: str | None = None):
+        self.cache = CacheFile(dbfile)
+
+    @staticmethod
+    def fold(name: str, collate: bytes) -> str:
+        """Get the words of a name to match, folded by the collate table."""
+
+        name = re.sub(r'\([^()]*\)', ' ', name)
+        return ' '.join(name.encode('latin1', 'replace')
+                        .translate(collate.ljust(256, b'?')[:256])
+                        .decode('latin1').split())
+
+    def directory(self, conn: kom.CachedUserConnection) \
+            -> tuple[int, bytes]:
+        """Get the server key and collate table, fetching the names when
+        they are missing or old.
+
+        Before logging in, the names are those anyone may see.  The
+        collate table is kept on the connection too, for case
+        insensitive regexps.
+        """
+
+        server = self.cache.server_id(conn.host, conn.port)
+        viewer = conn.get_user()
+        directory = self.cache.name_directory(server, viewer)
+        if directory is not None \
+           and directory[0] + self.max_age > time.time():
+            if conn.collate_table is None:
+                conn.set_collate_table(directory[1])
+            return server, directory[1]
+
+        names_req = kom.ReqLookupZName(conn, '', want_pers=1, want_confs=1)
+        collate = conn.get_collate_table()
+        self.cache.set_name_directory(
+            server, viewer, collate,
+            ((info.conf_no, name, self.fold(name, collate),
+              info.type.letterbox)
+             for info in names_req.response()
+             for name in [info.name.decode('latin1')]))
+        return server, collate
+
+    def lookup_name(self, conn: kom.CachedUserConnection, name: str,
+                    want_pers: int, want_confs: int) \
+            -> list[tuple[int, str]]:
+        """Look up a name like CachedConnection.lookup_name."""
+
+        if name[:1] == '#':
+            return conn.lookup_name(name, want_pers, want_confs)
+        server, collate = self.directory(conn)
+        viewer = conn.get_user()
+        words = self.fold(name, collate).split()
+        candidates = self.cache.names_from(server, viewer,
+                                           words[0] if words else '',
+                                           bool(want_pers),
+                                           bool(want_confs))
+        matches = []
+        for conf_no, conf_name, folded in candidates:
+            name_words = folded.split()
+            if len(words) <= len(name_words) \
+               and all(name_word.startswith(word)
+                       for word, name_word in zip(words, name_words)):
+                matches.append((conf_no, conf_name))
+        if not matches:
+            return conn.lookup_name(name, want_pers, want_confs)
+        return matches
+
+    def collate_table(self, conn: kom.CachedUserConnection) -> bytes:
+        """Get the collate table, kept with the directory."""
+
+        return self.directory(conn)[1]
+
+    def lookup_person(self, conn: kom.CachedUserConnection,
+                      name: str) -> list[tuple[int, str]]:
+        """Look up a person, for logging in."""
+
+        return self.lookup_name(conn, name, 1, 0)
+
+
+def get_conf_no(conn: kom.CachedUserConnection, name: str,
+                want_confs: bool, names: NameDirectory | None = None):
+    """Get conference number for person or conference."""
+
+    if names is not None:
+        matches = names.lookup_name(conn, name, 1, int(want_confs))
+    else:
+        matches = conn.lookup_name(name, 1, int(want_confs))
+    if len(matches) == 0:
+        raise ArgumentError(f'{name} - recipient not found')
+    if len(matches) != 1:
+        raise ArgumentError(f'{name} - ambiguous recipient')
+    return matches[0][0]
+
+
+def get_conf_nos(conn: kom.CachedUserConnection, names: list[str],
+                 regexps: list[str], want_confs: bool,
+                 directory: NameDirectory | None = None) -> list[int]:
+    """Get the numbers of persons or conferences by name or regexp."""
+
+    conf_nos = [get_conf_no(conn, name, want_confs, directory)
+                for name in names]
+    if regexps and directory is not None:
+        # Make the regexps case insensitive with the cached collate table
+        directory.collate_table(conn)
+    for regexp in regexps:
+        matches = conn.regexp_lookup(regexp, 1, int(want_confs))
+        if len(matches) == 0:
+            raise ArgumentError(f'{regexp} - no recipient matches')
+        conf_nos.extend(no for no, _ in matches)
+    return list(dict.fromkeys(conf_nos))
+
+
+def search(conn: kom.CachedUserConnection, patterns: list[str],
+           conf_nos: list[int] | None = None,
+           author_nos: list[int] | None = None, *,
+           marked: bool = False, member_confs: bool = False,
+           unread: bool = False, since: float | None = None,
+           before: float | None = None, newest_first: bool = True,
+           include_subject: bool = False, ignore_case: bool = False,
+           fixed_strings: bool = False, max_per_text: int | None = None,
+           window: int = 32, cache_file: str | None = None,
+           content_store: str | None = None) -> typing.Iterator[Match]:
+    """Search texts like the pykomgrep command does, yielding a Match
+    for each matching line.
+
+    The texts are fetched as the matches are asked for, so a search
+    stops when the generator is closed, which also closes the cache.
+    Names are looked up with get_conf_no.  EmptyListError is raised
+    when there is nothing to search.
+    """
+
+    textlist = Textlist(conn, False, cache_file,
+                        content_store=content_store)
+    try:
+        textlist.populate(conf_nos or [], author_nos or [], marked,
+                          member_confs, unread, since, before,
+                          newest_first, window)
+        yield from textlist.search(patterns, include_subject, ignore_case,
+                                   fixed_strings, max_per_text, window,
+                                   conn.get_collate_table()
+                                   if ignore_case else None)
+    finally:
+        textlist.cache.close()
+
+
+def connection_options(args: argparse.Namespace) -> dict[str, str | None]:
+    """Get where a command connects and caches, as komconnect and Cache
+    would find it, for the daemon to compare with its own.  The password
+    is hashed."""
+
+    password = args.password or os.environ.get('KOMPASSWORD')
+    return {'server': args.server or os.environ.get('KOMSERVER'),
+            'name': args.name or os.environ.get('KOMNAME'),
+            'password': hashlib.sha256(password.encode()).hexdigest()
+            if password is not None else None,
+            'cache': os.path.abspath(args.cache or default_cache_file()),
+            'content_store': args.content_store}
+
+
+def add_cache_argument(parser: argparse.ArgumentParser):
+    """Add the cache location arguments to a parser."""
+
+    parser.add_argument('--cache', action='store', metavar='FILE',
+                        default=os.environ.get('PYKOMGREP_CACHE'),
+                        help='keep the cache in FILE (default'
+                        ' $PYKOMGREP_CACHE or'
+                        ' $XDG_CACHE_HOME/pykomgrep/cache.sqlite)')
+    parser.add_argument('--content-store', action='store',
+                        choices=['sqlite', 'mmap'],
+                        help='keep new text contents in the SQLite cache or'
+                        ' in an append-only file read through mmap, from'
+                        ' now on (default as chosen before, or sqlite)')
+
+
+def parse_cmdline(argv: list[str] | None = None):
+    """Parse command line arguments, or argv if given."""
+
+    parser = argparse.ArgumentParser(description='Grep in LysKOM texts')
+    parser.add_argument('--conf', '-c', action='append', default=[],
+                        help='search only texts in conference CONF, may be'
+                        ' repeated')
+    parser.add_argument('--conf-regexp', action='append', default=[],
+                        metavar='REGEXP',
+                        help='search only texts in conferences with names'
+                        ' matching REGEXP, may be repeated')
+    parser.add_argument('--author', '-a', action='append', default=[],
+                        help='search only texts by author AUTHOR, may be'
+                        ' repeated')
+    parser.add_argument('--author-regexp', action='append', default=[],
+                        metavar='REGEXP',
+                        help='search only texts by authors with names'
+                        ' matching REGEXP, may be repeated')
+    parser.add_argument('--marked', '-m', action='store_true',
+                        help='search only marked texts')
+    parser.add_argument('--member-confs', '-M', action='store_true',
+                        help='search only texts in conferences you are'
+                        ' a member of')
+    parser.add_argument('--unread', '-u', action='store_true',
+                        help='search only texts you have not read, in the'
+                        ' conferences given or in all conferences you are'
+                        ' a member of')
+    parser.add_argument('--since', '-s', action='store', metavar='DATE',
+                        type=parsetime,
+                        help='search only texts written since DATE')
+    parser.add_argument('--before', '-b', action='store', metavar='DATE',
+                        type=parsetime,
+                        help='search only texts written before DATE')
+    parser.add_argument('--oldest-first', '-o', action='store_true',
+                        help='start with the oldest text found')
+    parser.add_argument('--ignore-case', '-i', action='store_true',
+                        help='ignore the case of the search string')
+    parser.add_argument('--include_subject', '-S', action='store_true',
+                        help='include the subject line in the search')
+    parser.add_argument('--recheck-after', action='store', type=float,
+                        default=30.0, metavar='DAYS',
+                        help='retry texts cached as unreadable after DAYS'
+                        ' (default 30)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='show more information')
+    parser.add_argument('--regexp', '-e', action='append', default=[],
+                        metavar='PATTERN',
+                        help='search for PATTERN, can be given several'
+                        ' times to find lines matching any of them')
+    parser.add_argument('--file', '-f', action='append', default=[],
+                        type=argparse.FileType('r'), metavar='FILE',
+                        help='search for the patterns in FILE, one per'
+                        ' line')
+    parser.add_argument('--fixed-strings', '-F', action='store_true',
+                        help='the patterns are strings to find as they'
+                        ' are, not regular expressions')
+    parser.add_argument('--max-count', action='store', type=parsecount,
+                        metavar='N',
+                        help='stop after N matching lines, or texts with'
+                        ' --texts-with-matches')
+    parser.add_argument('--max-per-text', action='store', type=parsecount,
+                        metavar='N',
+                        help='show at most N matching lines of each text')
+    parser.add_argument('--texts-with-matches', '-l', action='store_true',
+                        help='only list the numbers of texts that match')
+    parser.add_argument('--window', '-w', action='store', type=int,
+                        default=32,
+                        help='number of texts to request before reading'
+                        ' responses (default 32)')
+    parser.add_argument('--follow', action='store_true',
+                        help='go on searching new texts as they are'
+                        ' created, until interrupted')
+    parser.add_argument('--save', action='store', metavar='NAME',
+                        help='save the search as NAME, with what it finds,'
+                        ' to search only new texts when run again with'
+                        ' pykomgrep saved NAME')
+    parser.add_argument('--socket', action='store', metavar='FILE',
+                        default=os.environ.get('PYKOMGREP_SOCKET'),
+                        help='let the daemon listening on FILE search,'
+                        ' with its connection and cache, if it is running'
+                        ' (default $PYKOMGREP_SOCKET)')
+    parser.add_argument('pattern', nargs='?', help='to search for')
+    add_cache_argument(parser)
+    komconnect.add_server_name_password(parser)
+    args = parser.parse_args(argv)
+    args.patterns = list(args.regexp)
+    for file in args.file:
+        args.patterns.extend(file.read().splitlines())
+        file.close()
+    if args.pattern is not None:
+        if args.regexp or args.file:
+            parser.error('give patterns either as an argument or with'
+                         ' --regexp and --file')
+        args.patterns.append(args.pattern)
+    if not args.patterns:
+        parser.error('no pattern given')
+    if args.save is not None and args.max_count is not None:
+        parser.error('a search stopped by --max-count can not be saved')
+    if args.follow and args.max_count is not None:
+        parser.error('a search stopped by --max-count can not follow new'
+                     ' texts')
+    if args.follow and args.marked:
+        parser.error('new texts are not marked, --marked can not follow'
+                     ' them')
+    return args
+
+
+def parse_sync_cmdline():
+    """Parse command line arguments for the sync command."""
+
+    parser = argparse.ArgumentParser(
+        prog='pykomgrep sync',
+        description='Mirror LysKOM texts into the local cache')
+    parser.add_argument('--conf', '-c', action='append', default=[],
+                        help='sync texts in conference CONF')
+    parser.add_argument('--conf-regexp', action='append', default=[],
+                        metavar='REGEXP',
+                        help='sync texts in conferences with names matching'
+                        ' REGEXP')
+    parser.add_argument('--author', '-a', action='append', default=[],
+                        help='sync texts by author AUTHOR')
+    parser.add_argument('--author-regexp', action='append', default=[],
+                        metavar='REGEXP',
+                        help='sync texts by authors with names matching'
+                        ' REGEXP')
+    parser.add_argument('--member-confs', '-M', action='store_true',
+                        help='sync texts in all conferences you are'
+                        ' a member of')
+    parser.add_argument('--window', '-w', action='store', type=int,
+                        default=32,
+                        help='number of texts to request before reading'
+                        ' responses (default 32)')
+    parser.add_argument('--batch', action='store', type=int, default=500,
+                        help='commit the cache every BATCH texts'
+                        ' (default 500)')
+    parser.add_argument('--recheck-after', action='store', type=float,
+                        default=30.0, metavar='DAYS',
+                        help='retry texts cached as unreadable after DAYS'
+                        ' (default 30)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='show more information')
+    add_cache_argument(parser)
+    komconnect.add_server_name_password(parser)
+    args = parser.parse_args(sys.argv[2:])
+    if not (args.conf or args.conf_regexp or args.author
+            or args.author_regexp or args.member_confs):
+        parser.error('nothing to sync, give --conf, --author or'
+                     ' --member-confs')
+    return args
+
+
+def parse_watch_cmdline():
+    """Parse command line arguments for the watch command."""
+
+    parser = argparse.ArgumentParser(
+        prog='pykomgrep watch',
+        description='Keep the local cache current as texts are created'
+        ' and deleted')
+    parser.add_argument('--window', '-w', action='store', type=int,
+                        default=32,
+                        help='number of texts to request before reading'
+                        ' responses (default 32)')
+    parser.add_argument('--commit-interval', action='store', type=float,
+                        default=10.0, metavar='SECONDS',
+                        help='commit the cache at least every SECONDS'
+                        ' (default 10)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='show more information')
+    add_cache_argument(parser)
+    komconnect.add_server_name_password(parser)
+    return parser.parse_args(sys.argv[2:])
+
+
+def parse_daemon_cmdline():
+    """Parse command line arguments for the daemon command."""
+
+    parser = argparse.ArgumentParser(
+        prog='pykomgrep daemon',
+        description='Stay logged in and search for pykomgrep --socket,'
+        ' keeping the local cache current meanwhile')
+    parser.add_argument('--socket', action='store', metavar='FILE',
+                        default=os.environ.get('PYKOMGREP_SOCKET')
+                        or default_socket_file(),
+                        help='listen on FILE (default $PYKOMGREP_SOCKET or'
+                        ' $XDG_RUNTIME_DIR/pykomgrep.socket)')
+    parser.add_argument('--window', '-w', action='store', type=int,
+                        default=32,
+                        help='number of texts to request before reading'
+                        ' responses (default 32)')
+    parser.add_argument('--commit-interval', action='store', type=float,
+                        default=10.0, metavar='SECONDS',
+                        help='commit the cache at least every SECONDS'
+                        ' (default 10)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='show more information')
+    add_cache_argument(parser)
+    komconnect.add_server_name_password(parser)
+    return parser.parse_args(sys.argv[2:])
+
+
+def parse_saved_cmdline():
+    """Parse command line arguments for the saved command."""
+
+    parser = argparse.ArgumentParser(
+        prog='pykomgrep saved',
+        description='Run a search saved with pykomgrep --save again,'
+        ' searching only the texts added since it was last run, or list'
+        ' the saved searches')
+    parser.add_argument('search', nargs='?', metavar='NAME',
+                        help='the search to run, all are listed if not'
+                        ' given')
+    parser.add_argument('--new', '-n', action='store_true',
+                        help='only show what was found in new texts')
+    parser.add_argument('--delete', action='store_true',
+                        help='delete the search instead')
+    parser.add_argument('--recheck-after', action='store', type=float,
+                        default=30.0, metavar='DAYS',
+                        help='retry texts cached as unreadable after DAYS'
+                        ' (default 30)')
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help='show more information')
+    parser.add_argument('--window', '-w', action='store', type=int,
+                        default=32,
+                        help='number of texts to request before reading'
+                        ' responses (default 32)')
+    add_cache_argument(parser)
+    komconnect.add_server_name_password(parser)
+    args = parser.parse_args(sys.argv[2:])
+    if args.delete and args.search is None:
+        parser.error('give the search to delete')
+    return args
+
+
+def parse_cache_cmdline():
+    """Parse command line arguments for the cache command."""
+
+    parser = argparse.ArgumentParser(
+        prog='pykomgrep cache',
+        description='Show what is in the local cache and keep it small.'
+        ' A maximum size is kept in the cache and enforced whenever'
+        ' pykomgrep is done with it.')
+    parser.add_argument('--max-size', action='store', type=parsesize,
+                        metavar='SIZE',
+                        help='keep the cache below SIZE (like 500M or 2G)'
+                        ' by dropping the contents of the least recently'
+                        ' searched texts, 0 for no limit')
+    parser.add_argument('--dedup', action='store_true',
+                        help='remove duplicate rows and compact the'
+                        ' content stores')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='rewrite the whole cache file, which also'
+                        ' lets caches from older versions be shrunk'
+                        ' while in use')
+    parser.add_argument('--export', action='store', metavar='FILE',
+                        help='write a compressed snapshot of the cache to'
+                        ' FILE')
+    parser.add_argument('--import', action='store', metavar='FILE',
+                        dest='import_',
+                        help='load a snapshot from FILE, replacing what is'
+                        ' cached for the servers in it')
+    add_cache_argument(parser)
+    return parser.parse_args(sys.argv[2:])
+
+
+class Pykomgrep:
+    """Grep through lyskom texts to find the information you need."""
+
+    # The arguments saved with a search
+    saved_options = ['patterns', 'conf', 'conf_regexp', 'author',
+                     'author_regexp', 'marked', 'member_confs', 'unread',
+                     'since', 'before', 'oldest_first', 'ignore_case',
+                     'include_subject', 'fixed_strings', 'max_per_text',
+                     'texts_with_matches']
+
+    def __init__(self):
+        self.args = parse_cmdline()
+        if self.args.socket is not None and not self.args.follow:
+            try:
+                status = self.query_daemon(self.args.socket,
+                                           connection_options(self.args))
+            except (FileNotFoundError, ConnectionRefusedError):
+                status = None  # No daemon, search here
+            if status is not None:
+                sys.exit(status)
+        self.names = NameDirectory(self.args.cache)
+        self.conn = komconnect.connect_and_login(self.args,
+                                                 self.names.lookup_person)
+
+        self.textlist = Textlist(self.conn, self.args.verbose,
+                                 self.args.cache,
+                                 self.args.recheck_after * 24 * 3600,
+                                 self.args.content_store)
+        signal.signal(signal.SIGINT, self.textlist.graceful)
+        self.search()
+        if self.args.follow:
+            sys.stdout.flush()
+            self.textlist.follow(self.search_new)
+
+        kom.ReqLogout(self.conn)
+
+    def grep(self, printed: list[tuple[int, str]] | None = None) -> None:
+        """Grep the texts in the list, adding the lines to printed."""
+
+        self.textlist.grep(self.args.patterns, self.args.include_subject,
+                           self.args.ignore_case, self.args.fixed_strings,
+                           self.args.max_count, self.args.max_per_text,
+                           self.args.texts_with_matches, self.args.window,
+                           self.names.collate_table(self.conn)
+                           if self.args.ignore_case else None,
+                           printed)
+
+    @staticmethod
+    def query_daemon(socket_file: str,
+                     connection: dict[str, str | None]) -> int | None:
+        """Let a daemon search, printing its output as it comes.
+
+        The command line is sent as a line of JSON along with the
+        working directory, to find files in, and the connection options.
+        The output ends with a NUL character and the exit status.  None
+        is returned if the daemon is connected or caches elsewhere.
+        """
+
+        with socket.socket(socket.AF_UNIX) as client:
+            client.connect(socket_file)
+            client.sendall(json.dumps({'cwd': os.getcwd(),
+                                       'argv': sys.argv[1:],
+                                       'connection': connection}).encode()
+                           + b'\n')
+            status = None
+            while data := client.recv(65536):
+                if status is not None:
+                    status += data
+                    continue
+                data, end, rest = data.partition(b'\0')
+                sys.stdout.buffer.write(data)
+                sys.stdout.buffer.flush()
+                if end:
+                    status = rest
+        if status == b'refused':
+            return None
+        return int(status or 1)
+
+    def search(self):
+        """Search as the command line arguments say.
+
+        A search to save is saved with the lines printed, up to the
+        highest text searched.  Saved again, searching only newer texts,
+        the lines are added to those saved before.
+        """
+
+        self.populate_textlist()
+        printed: list[tuple[int, str]] | None = None
+        if self.args.save is not None:
+            printed = []
+            if not self.textlist.after:
+                self.textlist.cache.delete_saved_search(self.args.save)
+        self.grep(printed)
+        if printed is not None:
+            self.textlist.cache.save_search(
+                self.args.save,
+                json.dumps({option: getattr(self.args, option)
+                            for option in self.saved_options}),
+                self.textlist.highest_searched, printed)
+
+    def search_new(self):
+        """Search new texts, as the command line arguments say."""
+
+        self.grep()
+        sys.stdout.flush()
+
+    def get_conf_no(self, name: str, want_confs: bool):
+        """Get conference number for person or conference."""
+
+        return get_conf_no(self.conn, name, want_confs, self.names)
+
+    def populate_textlist(self):
+        """Build a textlist fulfilling the command line arguments."""
+
+        conf_nos = get_conf_nos(self.conn, self.args.conf,
+                                self.args.conf_regexp, True, self.names)
+        author_nos = get_conf_nos(self.conn, self.args.author,
+                                  self.args.author_regexp, False, self.names)
+        self.textlist.populate(conf_nos, author_nos, self.args.marked,
+                               self.args.member_confs, self.args.unread,
+                               self.args.since, self.args.before,
+                               not self.args.oldest_first, self.args.window)
+
+
+class PykomgrepSync:
+    """Mirror texts into the cache so that later searches hit it."""
+
+    def __init__(self):
+        self.args = parse_sync_cmdline()
+        self.names = NameDirectory(self.args.cache)
+        self.conn = komconnect.connect_and_login(self.args,
+                                                 self.names.lookup_person)
+
+        self.textlist = Textlist(self.conn, self.args.verbose,
+                                 self.args.cache,
+                                 self.args.recheck_after * 24 * 3600,
+                                 self.args.content_store)
+        signal.signal(signal.SIGINT, self.textlist.graceful)
+        conf_nos = self.conf_nos()
+        author_nos = get_conf_nos(self.conn, self.args.author,
+                                  self.args.author_regexp, False, self.names)
+        self.textlist.verbose(f'{len(conf_nos)} conferences and'
+                              f' {len(author_nos)} authors to sync')
+        texts = self.textlist.fetch_textnos_in_confs(conf_nos,
+                                                     self.args.window)
+        texts = texts.union(self.textlist.fetch_textnos_by_authors(
+            author_nos, self.args.window))
+        self.textlist.cache.commit()
+
+        self.textlist.verbose(f'{len(texts)} texts in mappings')
+        fetched = self.textlist.sync_texts(reversed(texts),
+                                           self.args.window,
+                                           self.args.batch)
+        self.textlist.verbose(f'{fetched} texts fetched')
+        self.textlist.verbose_statistics()
+
+        kom.ReqLogout(self.conn)
+
+    def conf_nos(self) -> list[int]:
+        """Get the conference numbers to sync."""
+
+        conf_nos = get_conf_nos(self.conn, self.args.conf,
+                                self.args.conf_regexp, True, self.names)
+        if self.args.member_confs:
+            conf_nos.extend(no for no in self.conn.get_member_confs()
+                            if no not in conf_nos)
+        return conf_nos
+
+
+class PykomgrepWatch:
+    """Keep the cache current while running."""
+
+    def __init__(self):
+        self.args = parse_watch_cmdline()
+        self.conn = komconnect.connect_and_login(
+            self.args, NameDirectory(self.args.cache).lookup_person)
+
+        self.textlist = Textlist(self.conn, self.args.verbose,
+                                 self.args.cache,
+                                 content_store=self.args.content_store)
+        signal.signal(signal.SIGINT, self.textlist.graceful)
+        watcher = CacheWatcher(self.textlist, self.args.window)
+        watcher.run(self.args.commit_interval)
+
+
+class PykomgrepDaemon(Pykomgrep):
+    """Search for clients on a Unix socket, staying logged in.
+
+    The connection, the name directory, the cache and what the
+    connection has cached stay from one search to the next, so a search
+    costs no startup.  The searches are answered one at a time, and the
+    cache is kept current in between like the watch command does.
+    """
+
+    def __init__(self):
+        self.daemon_args = parse_daemon_cmdline()
+        # Searches change directory, relative paths must not follow
+        if self.daemon_args.cache is not None:
+            self.daemon_args.cache = os.path.abspath(self.daemon_args.cache)
+        self.connection = connection_options(self.daemon_args)
+        self.names = NameDirectory(self.daemon_args.cache)
+        self.conn = komconnect.connect_and_login(self.daemon_args,
+                                                 self.names.lookup_person)
+        self.names.directory(self.conn)
+
+        self.textlist = Textlist(self.conn, self.daemon_args.verbose,
+                                 self.daemon_args.cache,
+                                 content_store=self.daemon_args.content_store)
+        signal.signal(signal.SIGINT, self.textlist.graceful)
+        watcher = CacheWatcher(self.textlist, self.daemon_args.window)
+        socket_file = os.path.abspath(self.daemon_args.socket)
+        os.makedirs(os.path.dirname(socket_file), exist_ok=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_file)
+        with socket.socket(socket.AF_UNIX) as server:
+            # Only the user may search as the user
+            umask = os.umask(0o177)
+            try:
+                server.bind(socket_file)
+            finally:
+                os.umask(umask)
+            server.listen()
+            try:
+                watcher.run(self.daemon_args.commit_interval, server,
+                            self.answer)
+            finally:
+                os.unlink(socket_file)
+
+    def answer(self, client: socket.socket) -> None:
+        """Search for a client, sending it the output and exit status."""
+
+        with client:
+            try:
+                with client.makefile('rb') as request, \
+                        client.makefile('w', encoding='utf-8') as output:
+                    output.reconfigure(line_buffering=True)
+                    query = json.loads(request.readline())
+                    if query.get('connection') != self.connection:
+                        # Another server, user or cache, let it search
+                        output.write('\0refused')
+                        return
+                    with contextlib.redirect_stdout(output), \
+                            contextlib.redirect_stderr(output):
+                        status = self.search_for(query['cwd'],
+                                                 query['argv'])
+                    output.write(f'\0{status}')
+            except (BrokenPipeError, ConnectionResetError,
+                    json.JSONDecodeError, KeyError):
+                pass  # The client is gone or did not send a search
+
+    def search_for(self, cwd: str, argv: list[str]) -> int:
+        """Search as a client's command line says, in its directory."""
+
+        daemon_cwd = os.getcwd()
+        try:
+            os.chdir(cwd)
+            self.args = parse_cmdline(argv)
+            self.textlist.clear()
+            self.textlist._verbose = self.args.verbose
+            self.textlist.recheck_after = self.args.recheck_after * 24 * 3600
+            self.search()
+        except SystemExit as exit:
+            return exit.code if isinstance(exit.code, int) else 1
+        except Exception:
+            # One failed search must not stop the others
+            traceback.print_exc()
+            return 1
+        finally:
+            os.chdir(daemon_cwd)
+            self.textlist.cache.commit()
+        return 0
+
+
+class PykomgrepSaved(Pykomgrep):
+    """Run saved searches again, searching only new texts."""
+
+    def __init__(self):
+        self.args = parse_saved_cmdline()
+        self.names = NameDirectory(self.args.cache)
+        self.conn = komconnect.connect_and_login(self.args,
+                                                 self.names.lookup_person)
+
+        self.textlist = Textlist(self.conn, self.args.verbose,
+                                 self.args.cache,
+                                 self.args.recheck_after * 24 * 3600,
+                                 self.args.content_store)
+        signal.signal(signal.SIGINT, self.textlist.graceful)
+        cache = self.textlist.cache
+        if self.args.search is None:
+            self.print_saved()
+        elif (saved := cache.saved_search(self.args.search)) is None:
+            raise ArgumentError(f'{self.args.search} - no such saved search')
+        elif self.args.delete:
+            cache.delete_saved_search(self.args.search)
+        else:
+            options, checked = saved
+            vars(self.args).update(json.loads(options))
+            self.args.save = self.args.search
+            self.args.max_count = None
+            self.textlist.newer_than(checked)
+            found = [] if self.args.new else \
+                cache.saved_matches(self.args.search,
+                                    not self.args.oldest_first)
+            if self.args.oldest_first:
+                for line in found:
+                    print(line)
+            self.search()
+            if not self.args.oldest_first:
+                for line in found:
+                    print(line)
+
+        kom.ReqLogout(self.conn)
+
+    def print_saved(self):
+        """List the saved searches."""
+
+        for name, options, checked, count in \
+                self.textlist.cache.saved_searches():
+            search = json.loads(options)
+            print(f'{name}: {" | ".join(search["patterns"])}'
+                  f' ({count} lines found up to text {checked})')
+
+
+class PykomgrepCache:
+    """Show statistics for the cache and maintain it."""
+
+    def __init__(self):
+        self.args = parse_cache_cmdline()
+        self.cache = CacheFile(self.args.cache)
+
+        before = self.cache.disk_usage()
+        if self.args.content_store is not None:
+            self.cache.set_content_store(self.args.content_store)
+        if self.args.import_:
+            self.cache.import_snapshot(self.args.import_,
+                                       self.args.content_store
+                                       or self.cache.content_store())
+            print(f'{self.args.import_} imported')
+        if self.args.dedup:
+            print(f'{self.cache.dedup()} duplicate rows removed')
+        if self.args.max_size is not None:
+            self.cache.set_max_size(self.args.max_size)
+        if evicted := self.cache.enforce_max_size(not self.args.dedup):
+            print(f'{evicted} texts evicted')
+        self.cache.vacuum(self.args.vacuum)
+        if not self.args.import_ \
+           and (reclaimed := before - self.cache.disk_usage()):
+            print(f'{formatsize(reclaimed)} reclaimed')
+        if self.args.export:
+            self.cache.export_snapshot(self.args.export)
+            print(f'{formatsize(os.path.getsize(self.args.export))}'
+                  f' written to {self.args.export}')
+        self.print_statistics()
+
+    def print_statistics(self):
+        """Print sizes and row counts for each server."""
+
+        limit = 'no limit'
+        if max_size := self.cache.max_size():
+            limit = f'limit {formatsize(max_size)}'
+        print(f'{self.cache.dbfile}:'
+              f' {formatsize(self.cache.disk_usage())} on disk,'
+              f' {formatsize(self.cache.size())} in use, {limit}')
+        for server, host, port in self.cache.servers():
+            print(f'{host}:{port}')
+            for table, count in self.cache.server_statistics(server).items():
+                print(f' {table:>16} {count:>8d}')
+
+
+def main():
+    """Run the pykomgrep command."""
+
+    if sys.argv[1:2] == ['sync']:
+        PykomgrepSync()
+    elif sys.argv[1:2] == ['watch']:
+        PykomgrepWatch()
+    elif sys.argv[1:2] == ['saved']:
+        PykomgrepSaved()
+    elif sys.argv[1:2] == ['daemon']:
+        PykomgrepDaemon()
+    elif sys.argv[1:2] == ['cache']:
+        PykomgrepCache()
+    else:
+        Pykomgrep()
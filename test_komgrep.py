@@ -0,0 +1,49 @@
+"""Tests for pattern matching in komgrep, runnable without a server."""
+
+import unittest
+
+import komgrep
+
+
+class CompilePatternsTest(unittest.TestCase):
+    """Several patterns match as if each was given alone."""
+
+    text = '\nfoo bar\naa\nbb\nab\nbar'
+
+    def test_alternatives(self):
+        matcher = komgrep.compile_patterns(['foo', 'bb'])
+        self.assertIsInstance(matcher, komgrep.Matcher)
+        self.assertEqual(matcher.findall(self.text), ['foo bar', 'bb'])
+
+    def test_backreferences(self):
+        matcher = komgrep.compile_patterns([r'(a)\1', r'(b)\1'])
+        self.assertEqual(matcher.findall(self.text), ['a', 'b'])
+
+    def test_repeated_group_names(self):
+        matcher = komgrep.compile_patterns([r'(?P<x>a)(?P=x)',
+                                            r'(?P<x>b)(?P=x)'])
+        self.assertEqual(matcher.findall(self.text), ['a', 'b'])
+
+    def test_group_in_one_pattern(self):
+        matcher = komgrep.compile_patterns(['(fo)o', 'bar'])
+        self.assertEqual(matcher.findall(self.text), ['fo', 'bar'])
+
+    def test_first_match_in_line_wins(self):
+        matcher = komgrep.compile_patterns(['(bar)', '(foo)'])
+        self.assertEqual(matcher.findall(self.text), ['foo', 'bar'])
+        lines = matcher.find_lines(self.text)
+        self.assertEqual([line[1:] for line in lines],
+                         [(1, 8, 1, 4), (18, 21, 18, 21)])
+
+    def test_ignore_case(self):
+        matcher = komgrep.compile_patterns(['(A)A', '(B)B'], True)
+        self.assertEqual(matcher.findall(self.text), ['a', 'b'])
+
+    def test_fixed_strings(self):
+        matcher = komgrep.compile_patterns(['(a)', 'bb'],
+                                           fixed_strings=True)
+        self.assertEqual(matcher.findall('x(a)\nbb\n(b)'), ['x(a)', 'bb'])
+
+
+if __name__ == '__main__':
+    unittest.main()